@@ -60,19 +60,25 @@ def text():
     title = request.json['title']
     body = request.json['body']
 
-    logging.debug(f"Recieved title={title} body={body}")
+    # Formatting the issue text is expensive for large issues so only do it
+    # when debug logging is enabled.
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    if debug:
+        logging.debug("Recieved title=%s body=%s", title, body)
     data = app.inference_wrapper.process_dict({'title':title, 'body':body})
-    logging.debug(f'prediction requested for {str(data)}')
+    if debug:
+        logging.debug('prediction requested for %s', data)
 
     # make prediction: you can only return strings with api
     # decode with np.frombuffer(request.content, dtype='<f4')
-    embeddings_str = app.inference_wrapper.get_pooled_features(data['text']).detach().numpy().tostring()
+    embeddings_str = app.inference_wrapper.get_pooled_features(data['text']).detach().numpy().tobytes()
 
     # For debugging print out hash of the content embeddings. This is to
     # see if they are changing
-    m = hashlib.md5()
-    m.update(embeddings_str)
-    logging.debug(f"hash of embeddings {m.hexdigest()}")
+    if debug:
+        m = hashlib.md5()
+        m.update(embeddings_str)
+        logging.debug("hash of embeddings %s", m.hexdigest())
     return embeddings_str
 
 @app.route("/all_issues/<string:owner>/<string:repo>", methods=["POST"])
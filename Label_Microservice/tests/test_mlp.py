@@ -1,6 +1,8 @@
 import pytest
-from label_microservice.mlp import MLPWrapper
+from label_microservice.mlp import MLPWrapper, mlp_predict_proba
+import dill as dpickle
 import numpy as np
+from sklearn.model_selection import GridSearchCV
 from sklearn.neural_network import MLPClassifier
 from sklearn.model_selection import train_test_split
 
@@ -23,6 +25,36 @@ def test_predict_probabilities():
     assert mlp_clf_pred.all() == mlp_wrap_pred.all()
 
 
+@pytest.mark.parametrize("activation", ["identity", "logistic", "tanh", "relu"])
+@pytest.mark.parametrize("multilabel", [True, False])
+def test_mlp_predict_proba_matches_sklearn(activation, multilabel):
+    X = np.random.rand(30, 5)
+    if multilabel:
+        y = np.random.choice([0, 1], size=(30, 4))
+    else:
+        y = np.random.choice([0, 1, 2], size=30)
+
+    mlp_clf = MLPClassifier(hidden_layer_sizes=(10, 10), activation=activation,
+                            max_iter=20, random_state=1234)
+    mlp_clf.fit(X, y)
+
+    np.testing.assert_allclose(mlp_predict_proba(mlp_clf, X),
+                               mlp_clf.predict_proba(X), rtol=1e-6)
+
+    # MLPWrapper computes in float32.
+    mlp_wrap = MLPWrapper(clf=mlp_clf)
+    np.testing.assert_allclose(mlp_wrap.predict_probabilities(X),
+                               mlp_clf.predict_proba(X), rtol=1e-4, atol=1e-6)
+
+    # GridSearchCV should use the best estimator.
+    search = GridSearchCV(MLPClassifier(max_iter=20, random_state=1234),
+                          {'alpha': [.01, .1]}, cv=2)
+    search.fit(X, y)
+    mlp_wrap = MLPWrapper(clf=search)
+    np.testing.assert_allclose(mlp_wrap.predict_probabilities(X),
+                               search.predict_proba(X), rtol=1e-4, atol=1e-6)
+
+
 def test_find_probability_thresholds():
     X = np.array([
         [0.1, 0.1],
@@ -57,3 +89,54 @@ def test_find_probability_thresholds():
     # in this case, only label 0 meets precision & recall thresholds
     assert not thresholds[1] and not thresholds[2] and\
         precision_0 >= precision_threshold and recall_0 >= recall_threshold
+
+
+def test_save_and_load_model(tmp_path):
+    X = np.random.rand(20, 5)
+    y = np.random.choice([0, 1], size=(20, 3))
+
+    mlp_clf = MLPClassifier(random_state=1234)
+    mlp_clf.fit(X, y)
+    expected = mlp_clf.predict_proba(X)
+
+    model_file = str(tmp_path / "model.dpkl")
+    MLPWrapper(clf=mlp_clf).save_model(model_file)
+    # Saving doesn't modify the classifier.
+    assert mlp_clf.coefs_[0].dtype == np.float64
+    loaded = MLPWrapper(clf=None, model_file=model_file, load_from_model=True)
+    np.testing.assert_allclose(loaded.predict_probabilities(X), expected,
+                               rtol=1e-4, atol=1e-6)
+
+    # The weights are saved as float32 and used from the memory mapped file
+    # without a copy.
+    for w in loaded.clf.coefs_ + loaded.clf.intercepts_:
+        assert isinstance(w, np.memmap)
+        assert w.dtype == np.float32
+    coefs, intercepts = loaded._float32_weights(loaded.clf)
+    assert coefs is loaded.clf.coefs_
+    assert intercepts is loaded.clf.intercepts_
+    assert loaded._weights is None
+
+    # The best estimator of a search is saved with float32 weights too.
+    search = GridSearchCV(MLPClassifier(max_iter=20, random_state=1234),
+                          {'alpha': [.01, .1]}, cv=2)
+    search.fit(X, y)
+    search_file = str(tmp_path / "search_model.dpkl")
+    MLPWrapper(clf=search).save_model(search_file)
+    assert search.best_estimator_.coefs_[0].dtype == np.float64
+    loaded = MLPWrapper(clf=None, model_file=search_file, load_from_model=True)
+    assert loaded.clf.best_estimator_.coefs_[0].dtype == np.float32
+    np.testing.assert_allclose(loaded.predict_probabilities(X),
+                               search.predict_proba(X), rtol=1e-4, atol=1e-6)
+
+    # Models saved with dill should still load.
+    dill_file = str(tmp_path / "dill_model.dpkl")
+    with open(dill_file, 'wb') as f:
+        dpickle.dump(mlp_clf, f)
+    loaded = MLPWrapper(clf=None, model_file=dill_file, load_from_model=True)
+    np.testing.assert_allclose(loaded.predict_probabilities(X), expected,
+                               rtol=1e-4, atol=1e-6)
+    # Legacy float64 weights are converted once.
+    coefs, _ = loaded._float32_weights(loaded.clf)
+    assert coefs[0].dtype == np.float32
+    assert loaded._float32_weights(loaded.clf)[0] is coefs
@@ -1,6 +1,8 @@
 from google.cloud import storage
 import logging
+import os
 import re
+import tempfile
 
 GCS_REGEX = re.compile("gs://([^/]*)(/.*)?")
 
@@ -83,6 +85,24 @@ def copy_from_gcs(gcs_path, local_filename, storage_client=None):
     bucket_name, gcs_file_name = split_gcs_uri(gcs_path)
     return download_file_from_gcs(bucket_name, gcs_file_name, local_filename, storage_client=storage_client)    
     
+def _download_blob(blob, local_filename):
+    """
+    Stream a blob to a temporary file and move it to local_filename.
+
+    Models are memory mapped when loaded; overwriting the file in place
+    would change the pages of a model that is still in use, so the new
+    file replaces the old one atomically instead.
+    """
+    local_dir = os.path.dirname(os.path.abspath(local_filename))
+    fd, temp_path = tempfile.mkstemp(dir=local_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            blob.download_to_file(f)
+        os.replace(temp_path, local_filename)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
 def download_file_from_gcs(bucket_name, gcs_filename, local_filename, storage_client=None):
     """
     Download a file in GCS to the local.
@@ -96,5 +116,31 @@ def download_file_from_gcs(bucket_name, gcs_filename, local_filename, storage_cl
         storage_client = storage.Client()
     bucket = storage_client.get_bucket(bucket_name)
     blob = bucket.get_blob(gcs_filename)
-    with open(local_filename, 'wb') as f:
-        blob.download_to_file(f)
+    _download_blob(blob, local_filename)
+
+def download_file_if_changed(bucket_name, gcs_filename, local_filename,
+                             generation=None, storage_client=None):
+    """
+    Download a file in GCS to the local unless the local copy is current.
+    Args:
+      bucket_name: bucket name, str
+      gcs_filename: the file name that is stored in GCS, str
+      local_filename: the new local file, str
+      generation: the generation of the object when local_filename was
+        last downloaded, int
+      storage_client: client to bundle configuration needed for API requests
+
+    Return
+    ------
+    int
+        the generation of the object in GCS
+    """
+    if not storage_client:
+        storage_client = storage.Client()
+    # bucket() doesn't make an API call so only the object metadata is fetched.
+    blob = storage_client.bucket(bucket_name).get_blob(gcs_filename)
+    if blob.generation == generation and os.path.exists(local_filename):
+        logging.info(f"{local_filename} is already at generation {generation}")
+        return generation
+    _download_blob(blob, local_filename)
+    return blob.generation
@@ -0,0 +1,77 @@
+"""Unittest for gcs_util. """
+import logging
+import os
+import pytest
+from unittest import mock
+
+from code_intelligence import gcs_util
+
+def _mock_client(generation, content=b"model"):
+  blob = mock.MagicMock()
+  blob.generation = generation
+  blob.download_to_file.side_effect = lambda f: f.write(content)
+  client = mock.MagicMock()
+  client.bucket.return_value.get_blob.return_value = blob
+  return client, blob
+
+def test_download_file_if_changed(tmp_path):
+  local_path = str(tmp_path / "model.dpkl")
+  client, blob = _mock_client(generation=5)
+
+  # No local copy.
+  generation = gcs_util.download_file_if_changed(
+    "bucket", "path/model.dpkl", local_path, storage_client=client)
+  assert generation == 5
+  assert blob.download_to_file.call_count == 1
+  with open(local_path, "rb") as f:
+    assert f.read() == b"model"
+
+  # Generation unchanged.
+  generation = gcs_util.download_file_if_changed(
+    "bucket", "path/model.dpkl", local_path, generation=5,
+    storage_client=client)
+  assert generation == 5
+  assert blob.download_to_file.call_count == 1
+
+  # Generation changed.
+  blob.generation = 6
+  blob.download_to_file.side_effect = lambda f: f.write(b"new model")
+  generation = gcs_util.download_file_if_changed(
+    "bucket", "path/model.dpkl", local_path, generation=5,
+    storage_client=client)
+  assert generation == 6
+  assert blob.download_to_file.call_count == 2
+  with open(local_path, "rb") as f:
+    assert f.read() == b"new model"
+
+  # Only the downloaded file should be left behind.
+  assert os.listdir(str(tmp_path)) == ["model.dpkl"]
+
+def test_download_file_if_changed_failure(tmp_path):
+  """A failed download should leave the local copy untouched."""
+  local_path = str(tmp_path / "model.dpkl")
+  with open(local_path, "wb") as f:
+    f.write(b"old model")
+
+  client, blob = _mock_client(generation=6)
+  blob.download_to_file.side_effect = IOError("connection reset")
+
+  with pytest.raises(IOError):
+    gcs_util.download_file_if_changed(
+      "bucket", "path/model.dpkl", local_path, generation=5,
+      storage_client=client)
+
+  with open(local_path, "rb") as f:
+    assert f.read() == b"old model"
+  assert os.listdir(str(tmp_path)) == ["model.dpkl"]
+
+if __name__ == "__main__":
+  logging.basicConfig(
+      level=logging.INFO,
+      format=('%(levelname)s|%(asctime)s'
+              '|%(pathname)s|%(lineno)d| %(message)s'),
+      datefmt='%Y-%m-%dT%H:%M:%S',
+  )
+  logging.getLogger().setLevel(logging.INFO)
+
+  pytest.main()
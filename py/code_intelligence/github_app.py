@@ -15,6 +15,8 @@ import requests
 from tqdm import tqdm
 from typing import List
 
+from code_intelligence import util
+
 class GitHubApp(GitHub):
     """
     This is a small wrapper around the github3.py library
@@ -129,8 +131,12 @@ class GitHubApp(GitHub):
                        'Accept': 'application/vnd.github.machine-man-preview+json'}
 
             response = requests.get(url=url, headers=headers)
+            if util.is_retryable_status(response.status_code):
+                raise util.RetryableError(
+                    f"There was a problem requesting URL={url} "
+                    f"Status code : {response.status_code}")
             if response.status_code != 200:
-                raise Exception(f"There was a problem requesting URL={URL} "
+                raise Exception(f"There was a problem requesting URL={url} "
                                 f"Status code : {response.status_code}, "
                                 f"Response:{response.json()}")
             self._installation_ids[key] = response.json()['id']
@@ -150,6 +156,10 @@ class GitHubApp(GitHub):
                    'Accept': 'application/vnd.github.machine-man-preview+json'}
 
         response = requests.post(url=url, headers=headers)
+        if util.is_retryable_status(response.status_code):
+            raise util.RetryableError(
+                f'Status code : {response.status_code} getting an access '
+                f'token for installation {installation_id}')
         if response.status_code != 201:
             raise Exception(f'Status code : {response.status_code}, {response.json()}')
         return response.json()['token']
@@ -1,9 +1,10 @@
 import fire
 import os
 import logging
+from github3 import exceptions as github3_exceptions
 from code_intelligence import github_app
+from code_intelligence import util
 import typing
-import yaml
 
 def get_issue_handle(installation_id, username, repository, number):
   "get an issue object."
@@ -11,11 +12,22 @@ def get_issue_handle(installation_id, username, repository, number):
   install = ghapp.get_installation(installation_id)
   return install.issue(username, repository, number)
 
-def get_yaml(owner, repo, ghapp=None):
+def get_yaml(owner, repo, ghapp=None, raise_errors=False):
   """
   Looks for the yaml file in a /.github directory.
 
   yaml file must be named issue_label_bot.yaml
+
+  Args:
+    owner: The repo owner.
+    repo: The repo name.
+    ghapp: (Optional) The GitHubApp to use.
+    raise_errors: If true errors other than the file not existing are
+      raised rather than logged; this lets callers tell a repo without
+      a config apart from a failed request.
+
+  Returns:
+    The parsed config or None if there isn't one.
   """
 
   if not ghapp:
@@ -30,14 +42,18 @@ def get_yaml(owner, repo, ghapp=None):
     # get the repo handle, which allows you got get the file contents
     repo = inst.repository(owner=owner, repository=repo)
     results = repo.file_contents('.github/issue_label_bot.yaml').decoded
+  except github3_exceptions.NotFoundError as e:
+    logging.info(f"No .github/issue_label_bot.yaml found: {e}")
+    return None
   # TODO(jlewi): We should probably catching more narrow exceptions and
-  # not swallowing all exceptions. The exceptions we should swallow are
-  # the ones related to the configuration file not existing.
+  # not swallowing all exceptions.
   except Exception as e:
+    if raise_errors:
+      raise
     logging.info(f"Exception occured getting .github/issue_label_bot.yaml: {e}")
     return None
 
-  return yaml.safe_load(results)
+  return util.load_yaml(results)
 
 def build_issue_doc(org:str, repo:str, title:str, text:typing.List[str]):
   """Build a document string out of various github features.
@@ -1,6 +1,9 @@
 """Unittest for github_util. """
 import logging
 import pytest
+from unittest import mock
+
+from github3 import exceptions as github3_exceptions
 
 from code_intelligence import github_util
 
@@ -14,6 +17,21 @@ line1
 line2"""
   assert result == expected
 
+def test_get_yaml_errors():
+  ghapp = mock.MagicMock()
+  repo = ghapp.get_installation.return_value.repository.return_value
+
+  # A missing config is not an error.
+  response = mock.MagicMock(status_code=404)
+  repo.file_contents.side_effect = github3_exceptions.NotFoundError(response)
+  assert github_util.get_yaml("owner", "repo", ghapp=ghapp,
+                              raise_errors=True) is None
+
+  repo.file_contents.side_effect = Exception("GitHub timed out")
+  assert github_util.get_yaml("owner", "repo", ghapp=ghapp) is None
+  with pytest.raises(Exception):
+    github_util.get_yaml("owner", "repo", ghapp=ghapp, raise_errors=True)
+
 if __name__ == "__main__":
   logging.basicConfig(
       level=logging.INFO,
@@ -65,6 +65,9 @@ class GraphQLClient(object):
                             json=payload, headers=header_values)
     if request.status_code == 200:
       return request.json()
+    elif util.is_retryable_status(request.status_code):
+      raise util.RetryableError(
+        f"Query failed with retryable status {request.status_code}")
     else:
 
       raise Exception("Query failed to run by returning code of {}. {}".format(
@@ -1,15 +1,31 @@
+import copy
 import datetime
+import functools
 import logging
 import json
+import os
 import pytz
 import re
+import yaml
 
 import json_log_formatter
 
+# orjson is considerably faster than the stdlib json module at serializing
+# log records; use it when it is installed.
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
 
 ISSUE_RE = re.compile("([^/]*)/([^#]*)#([0-9]*)")
 ISSUE_URL_RE = re.compile("https://github.com/([^/]*)/([^#]*)/issues/([0-9]*)")
 
+# Use the LibYAML bindings when PyYAML was built with them; CSafeLoader is
+# significantly faster than the pure python SafeLoader and accepts the same
+# documents.
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 # TODO(jlewi): Might be better to just write it
 # as a json list
 def write_items_to_json(output_file, results):
@@ -19,6 +35,38 @@ def write_items_to_json(output_file, results):
       hf.write("\n")
   logging.info("Wrote %s items to %s", len(results), output_file)
 
+def load_yaml(stream):
+  """Safely parse a YAML document using the fastest available loader.
+
+  Args:
+    stream: A string, bytes or file like object containing the YAML.
+
+  Returns:
+    The parsed document.
+  """
+  return yaml.load(stream, Loader=YAML_LOADER)
+
+@functools.lru_cache(maxsize=128)
+def _load_yaml_file(path, mtime_ns, size):
+  """Parse a YAML file; cached on the file's modification time and size."""
+  with open(path) as hf:
+    return load_yaml(hf)
+
+def load_yaml_file(path):
+  """Load a YAML file reusing the parsed contents if the file is unchanged.
+
+  Parsed documents are cached process wide keyed by the path, modification
+  time and size of the file so modifying the file invalidates the cache.
+
+  Args:
+    path: Path of the YAML file.
+
+  Returns:
+    A copy of the parsed document; callers are free to modify it.
+  """
+  stat = os.stat(path)
+  return copy.deepcopy(_load_yaml_file(path, stat.st_mtime_ns, stat.st_size))
+
 def parse_issue_spec(issue):
   """Parse an issue in the form {owner}/{repo}#{number}
 
@@ -60,6 +108,17 @@ def build_issue_url(org, repo, number):
   """
   return f"https://github.com/{org}/{repo}/issues/{number}"
 
+class RetryableError(Exception):
+  """A request failed in a way that is likely transient.
+
+  For example the server returned a 5xx or 429 response; retrying the
+  request later may succeed.
+  """
+
+def is_retryable_status(status_code):
+  """Return true if an HTTP status code indicates a transient failure."""
+  return status_code == 429 or status_code >= 500
+
 pacific = pytz.timezone("US/Pacific")
 
 def now():
@@ -81,3 +140,13 @@ class CustomisedJSONFormatter(json_log_formatter.JSONFormatter):
     extra["thread"] = record.thread
     extra["thread_name"] = record.threadName
     return extra
+
+  def to_json(self, record):
+    if orjson is None:
+      return super().to_json(record)
+
+    # Fall back to str for values orjson can't serialize rather than
+    # failing to log the message.
+    return orjson.dumps(
+      record, default=str,
+      option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
@@ -1,3 +1,4 @@
+import json
 import logging
 import pytest
 
@@ -28,6 +29,45 @@ def test_build_issue_url():
   expected = "https://github.com/kubeflow/testing/issues/1234"
   assert url == expected
 
+def test_load_yaml_file(tmp_path):
+  path = tmp_path / "config.yaml"
+  path.write_text("orgs:\n- name: kubeflow\n")
+
+  first = util.load_yaml_file(str(path))
+  assert first == {"orgs": [{"name": "kubeflow"}]}
+
+  # Modifying the result shouldn't modify the cached copy.
+  first["orgs"].append({"name": "other"})
+  assert util.load_yaml_file(str(path)) == {"orgs": [{"name": "kubeflow"}]}
+
+  # Changing the file should invalidate the cache.
+  path.write_text("orgs:\n- name: kubeflow\n- name: tensorflow\n")
+  assert util.load_yaml_file(str(path)) == {
+    "orgs": [{"name": "kubeflow"}, {"name": "tensorflow"}]}
+
+def test_json_formatter():
+  record = logging.LogRecord("test", logging.INFO, "some_file.py", 10,
+                             "Got %s", ("labels",), None)
+  record.predictions = {"bug": .5}
+
+  actual = json.loads(util.CustomisedJSONFormatter().format(record))
+
+  assert actual["message"] == "Got labels"
+  assert actual["predictions"] == {"bug": .5}
+  assert actual["filename"] == "some_file.py"
+  assert actual["line"] == 10
+  assert actual["level"] == "INFO"
+
+@pytest.mark.parametrize("status_code, expected", [
+  (200, False),
+  (404, False),
+  (429, True),
+  (500, True),
+  (503, True),
+])
+def test_is_retryable_status(status_code, expected):
+  assert util.is_retryable_status(status_code) == expected
+
 if __name__ == "__main__":
   logging.basicConfig(
       level=logging.INFO,
@@ -0,0 +1,89 @@
+"""Coalesce concurrent prediction requests into batches."""
+
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+class MicroBatcher:
+  """Group concurrent requests into a single call of a batch function.
+
+  Callers submit individual items. A background thread collects up to
+  max_batch_size items, waiting at most max_wait_secs after the first item
+  arrives, and invokes batch_fn once for the whole batch. This amortizes
+  the fixed per call overhead of model inference over all requests that
+  are in flight at the same time.
+
+  Since batch_fn is only ever invoked from the background thread calls
+  to it are serialized.
+  """
+
+  def __init__(self, batch_fn, max_batch_size=32, max_wait_secs=.005,
+               name="micro-batcher"):
+    """Create the batcher and start the background thread.
+
+    Args:
+      batch_fn: Function taking a list of items and returning a sequence
+        of results with the same length and order.
+      max_batch_size: The maximum number of items to pass to batch_fn.
+      max_wait_secs: How long to wait for more items after the first item
+        of a batch arrives.
+      name: Name for the background thread.
+    """
+    self._batch_fn = batch_fn
+    self._max_batch_size = max_batch_size
+    self._max_wait_secs = max_wait_secs
+    self._queue = queue.Queue()
+    self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+    self._thread.start()
+
+  def submit(self, item):
+    """Submit an item and return a future for its result.
+
+    Args:
+      item: The item to pass to batch_fn.
+
+    Returns:
+      concurrent.futures.Future
+    """
+    future = concurrent.futures.Future()
+    self._queue.put((item, future))
+    return future
+
+  def predict(self, item):
+    """Submit an item and block until its result is available."""
+    return self.submit(item).result()
+
+  def _next_batch(self):
+    """Block until at least one item is available and return a batch."""
+    batch = [self._queue.get()]
+    deadline = time.monotonic() + self._max_wait_secs
+    while len(batch) < self._max_batch_size:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        break
+      try:
+        batch.append(self._queue.get(timeout=remaining))
+      except queue.Empty:
+        break
+    return batch
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      items = [item for item, _ in batch]
+      try:
+        results = self._batch_fn(items)
+        if len(results) != len(items):
+          raise ValueError(f"batch_fn returned {len(results)} results for "
+                           f"{len(items)} items")
+      # Propagate errors to the callers rather than killing the thread.
+      except Exception as e: # pylint: disable=broad-except
+        logging.error(f"Batch of {len(items)} items failed: {e}")
+        for _, future in batch:
+          future.set_exception(e)
+        continue
+
+      for (_, future), result in zip(batch, results):
+        future.set_result(result)
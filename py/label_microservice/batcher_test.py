@@ -0,0 +1,72 @@
+"""Unittest for batcher. """
+import logging
+import pytest
+
+from label_microservice import batcher
+
+def test_predict_batches_concurrent_items():
+  """Items submitted together should be handled in a single batch."""
+  batches = []
+
+  def batch_fn(items):
+    batches.append(list(items))
+    return [i * 2 for i in items]
+
+  b = batcher.MicroBatcher(batch_fn, max_batch_size=8, max_wait_secs=.2)
+
+  futures = [b.submit(i) for i in range(3)]
+  results = [f.result(timeout=5) for f in futures]
+
+  assert results == [0, 2, 4]
+  assert batches == [[0, 1, 2]]
+
+def test_predict_respects_max_batch_size():
+  batches = []
+
+  def batch_fn(items):
+    batches.append(list(items))
+    return items
+
+  b = batcher.MicroBatcher(batch_fn, max_batch_size=2, max_wait_secs=.2)
+
+  futures = [b.submit(i) for i in range(5)]
+  results = [f.result(timeout=5) for f in futures]
+
+  assert results == list(range(5))
+  assert [len(i) for i in batches] == [2, 2, 1]
+
+def test_predict_propagates_errors():
+  def batch_fn(items):
+    raise ValueError("bad batch")
+
+  b = batcher.MicroBatcher(batch_fn, max_wait_secs=0)
+
+  with pytest.raises(ValueError):
+    b.predict(1)
+
+  # The batcher should keep working after an error.
+  with pytest.raises(ValueError):
+    b.predict(2)
+
+def test_predict_wrong_number_of_results():
+  """Callers should get an error rather than block if results are missing."""
+  def batch_fn(items):
+    return items[:-1]
+
+  b = batcher.MicroBatcher(batch_fn, max_batch_size=8, max_wait_secs=.2)
+
+  futures = [b.submit(i) for i in range(3)]
+  for f in futures:
+    with pytest.raises(ValueError):
+      f.result(timeout=5)
+
+if __name__ == "__main__":
+  logging.basicConfig(
+      level=logging.INFO,
+      format=('%(levelname)s|%(asctime)s'
+              '|%(pathname)s|%(lineno)d| %(message)s'),
+      datefmt='%Y-%m-%dT%H:%M:%S',
+  )
+  logging.getLogger().setLevel(logging.INFO)
+
+  pytest.main()
@@ -1,6 +1,7 @@
+import cachetools
 import logging
 import os
-import yaml
+import threading
 
 from code_intelligence import github_app
 from code_intelligence import graphql
@@ -12,6 +13,11 @@ from label_microservice import universal_kind_label_model as universal_model
 
 UNIVERSAL_MODEL_NAME = "universal"
 
+# How long to reuse issue data fetched from GitHub. Webhooks are frequently
+# retried or duplicated within a short window.
+ISSUE_CACHE_TTL_SECONDS = 60
+ISSUE_CACHE_SIZE = 10000
+
 def _combined_model_name(org, repo=None):
   """Return the name of the combined model for a repo or organization.
 
@@ -27,12 +33,9 @@ def _combined_model_name(org, repo=None):
 
   return f"{org}_combined"
 
-def _dict_has_keys(d, keys):
-  for k in keys:
-    if not k in d:
-      return False
-
-  return True
+# Keys required in the payload passed to IssueLabelPredictor.predict.
+_TEXT_KEYS = frozenset(["title", "text", "model_name"])
+_ISSUE_KEYS = frozenset(["repo_owner", "repo_name", "issue_num"])
 
 class IssueLabelPredictor:
   """Predict labels for an issue.
@@ -47,6 +50,13 @@ class IssueLabelPredictor:
 
     # A dictionary mapping keys to individual models.
     self._models = {}
+    # A dictionary mapping (org, repo) to the name of the model to use for
+    # issues in that repo. repo is None for org wide models.
+    self._routing = {}
+
+    self._issue_cache = cachetools.TTLCache(maxsize=ISSUE_CACHE_SIZE,
+                                            ttl=ISSUE_CACHE_TTL_SECONDS)
+    self._issue_cache_lock = threading.Lock()
     self._load_models()
     self._gh_client = graphql.GraphQLClient()
 
@@ -58,14 +68,16 @@ class IssueLabelPredictor:
   def _load_models(self):
     """Load the models."""
     logging.info("Loading the universal model")
-    self._models[UNIVERSAL_MODEL_NAME] = universal_model.UniversalKindLabelModel()
+    # UNIVERSAL_TFLITE_MODEL_URL can be set to serve a TFLite version of
+    # the model; see universal_kind_label_model.convert_to_tflite.
+    self._models[UNIVERSAL_MODEL_NAME] = universal_model.UniversalKindLabelModel(
+      tflite_model_url=os.getenv("UNIVERSAL_TFLITE_MODEL_URL"))
 
     model_config_path = os.getenv("MODEL_CONFIG")
 
     if model_config_path:
       logging.info(f"Loading model config from {model_config_path}")
-      with open(model_config_path) as fh:
-        model_config = yaml.load(fh)
+      model_config = util.load_yaml_file(model_config_path)
     else:
       logging.info("Environment variable MODEL_CONFIG not set; no config "
                    "loaded.")
@@ -84,7 +96,9 @@ class IssueLabelPredictor:
 
         combined = combined_model.CombinedLabelModels(
                 models=[self._models["universal"], org_model])
-        self._models[_combined_model_name(org_name)] = combined
+        combined_name = _combined_model_name(org_name)
+        self._models[combined_name] = combined
+        self._routing[(org_name, None)] = combined_name
 
 
   def predict_labels_for_data(self, model_name, org, repo, title, text,
@@ -128,6 +142,31 @@ class IssueLabelPredictor:
 
     return gh_client
 
+  def _get_issue(self, org, repo, issue_number):
+    """Fetch the data for an issue reusing recently fetched results.
+
+    Args:
+      org: The GitHub organization
+      repo: The repo that owns the issue
+      issue_number: The github issue number
+
+    Returns
+      dict: The issue data as returned by github_util.get_issue.
+    """
+    key = (org, repo, str(issue_number))
+    with self._issue_cache_lock:
+      data = self._issue_cache.get(key)
+
+    if data is None:
+      url = util.build_issue_url(org, repo, issue_number)
+      data = github_util.get_issue(url, self.graphql_client(org, repo))
+      with self._issue_cache_lock:
+        self._issue_cache[key] = data
+    else:
+      logging.info(f"Using cached data for {org}/{repo}#{issue_number}")
+
+    return data
+
   def predict_labels_for_issue(self, org, repo, issue_number, model_name=None):
     """Generate label predictions for a github issue.
 
@@ -144,23 +183,17 @@ class IssueLabelPredictor:
      dict: str -> float; dictionary mapping labels to their probability
     """
     if not model_name:
-      org_model = _combined_model_name(org)
-      repo_model = _combined_model_name(org, repo)
-
-      if repo_model in self._models:
-        model_name = repo_model
-      elif org_model in self._models:
-        model_name = org_model
-      else:
-        model_name = UNIVERSAL_MODEL_NAME
+      # Prefer a repo specific model, then an org wide model.
+      model_name = self._routing.get((org, repo))
+      if not model_name:
+        model_name = self._routing.get((org, None), UNIVERSAL_MODEL_NAME)
 
     logging.info(f"Predict labels for "
                  f"{org}/{repo}#{issue_number} using "
                  f"model {model_name}")
 
 
-    url = util.build_issue_url(org, repo, issue_number)
-    data = github_util.get_issue(url, self.graphql_client(org, repo))
+    data = self._get_issue(org, repo, issue_number)
 
     if not data.get("title"):
       logging.warning(f"Got empty title for {org}/{repo}#{issue_number}")
@@ -207,21 +240,20 @@ class IssueLabelPredictor:
           ...
         }
     """
-    text_keys = ["title", "text", "model_name"]
-    issue_keys = ["repo_owner", "repo_name", "issue_num"]
-    if _dict_has_keys(data, text_keys): # pylint: disable=no-else-return
+    keys = data.keys()
+    if _TEXT_KEYS <= keys: # pylint: disable=no-else-return
       return self.predict_labels_for_data(data["model_name"], data["repo_owner"],
-                                          data["repo_name"]. data["title"],
+                                          data["repo_name"], data["title"],
                                           data["text"])
-    elif _dict_has_keys(data, issue_keys):  # pylint: disable=no-else-return
+    elif _ISSUE_KEYS <= keys:  # pylint: disable=no-else-return
       return self.predict_labels_for_issue(data["repo_owner"],
                                            data["repo_name"],
                                            data["issue_num"],
                                            model_name=data.get("model_name"))
     else:
       actual = ",".join(data.keys())
-      text_str = ",".join(text_keys)
-      issue_str = ",".join(issue_keys)
+      text_str = ",".join(sorted(_TEXT_KEYS))
+      issue_str = ",".join(sorted(_ISSUE_KEYS))
       want = f"[{text_str}] or [{issue_str}]"
       logging.error(f"Data is missing required keys; got {actual}; want {want}")
       raise ValueError(f"Data is missing required keys; got {actual}; want {want}")
@@ -4,11 +4,122 @@ from sklearn.model_selection import train_test_split
 from sklearn.metrics import precision_recall_curve
 from sklearn.metrics import roc_auc_score
 
+import copy
 import os
 import dill as dpickle
+import joblib
+from joblib import Parallel, delayed
 import numpy as np
 import pandas as pd
 import logging
+from scipy.special import expit
+
+
+# hidden layer activation functions supported by MLPClassifier
+_ACTIVATIONS = {
+    'identity': lambda x: x,
+    'logistic': expit,
+    'tanh': np.tanh,
+    'relu': lambda x: np.maximum(x, 0),
+}
+
+
+def _softmax(x):
+    exp = np.exp(x - x.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def mlp_predict_proba(clf, X, coefs=None, intercepts=None):
+    """Compute MLPClassifier.predict_proba directly with numpy
+    This skips sklearn's per call input validation and dispatch, which
+    dominates the cost when predicting a handful of samples at a time.
+    Args:
+      clf: a fitted sklearn.neural_network.MLPClassifier object
+      X: features, numpy.array
+      coefs: weights to use instead of clf.coefs_, list of numpy.array
+      intercepts: biases to use instead of clf.intercepts_, list of numpy.array
+
+    Return: a numpy.array, shape (n_samples, n_classes)
+    """
+    if coefs is None:
+        coefs, intercepts = clf.coefs_, clf.intercepts_
+    hidden_activation = _ACTIVATIONS[clf.activation]
+    # compute in the precision of the weights
+    activations = np.asarray(X, dtype=coefs[0].dtype)
+    last_layer = len(coefs) - 1
+    for i, (coef, intercept) in enumerate(zip(coefs, intercepts)):
+        activations = np.dot(activations, coef) + intercept
+        if i < last_layer:
+            activations = hidden_activation(activations)
+
+    if clf.out_activation_ == 'softmax':
+        y_pred = _softmax(activations)
+    else:
+        y_pred = expit(activations)
+
+    # same as sklearn: a single binary output is returned as two columns
+    if clf.n_outputs_ == 1:
+        y_pred = y_pred.ravel()
+        return np.vstack([1 - y_pred, y_pred]).T
+    return y_pred
+
+
+def find_label_threshold(y_true, y_score, precision_threshold, recall_threshold):
+    """Find the probability threshold with the highest precision for one label
+    Args:
+      y_true: true binary labels, numpy.array
+      y_score: predicted probabilities, numpy.array
+      precision_threshold: the threshold that the precision must meet
+      recall_threshold: the threshold that the recall must meet
+
+    Return: (precision, recall, threshold); threshold is None if no threshold
+            satisfies both the precision and recall thresholds
+    """
+    best_precision, best_recall, best_threshold = 0.0, 0.0, None
+    precision, recall, threshold = precision_recall_curve(y_true, y_score)
+    # the last precision and recall values have no corresponding threshold
+    precision, recall = precision[:-1], recall[:-1]
+    # precision, recall must meet two thresholds respecitively;
+    # a threshold with zero precision is never chosen
+    candidates = ((precision >= precision_threshold) &
+                  (recall >= recall_threshold) &
+                  (precision > 0))
+    if candidates.any():
+        # choose the threshold with the highest precision;
+        # argmax picks the first one in case of ties
+        best = np.argmax(np.where(candidates, precision, -1.0))
+        best_precision = precision[best]
+        best_recall = recall[best]
+        best_threshold = threshold[best]
+    return best_precision, best_recall, best_threshold
+
+
+def _has_float32_weights(clf):
+    """Return true if all weights of a fitted MLPClassifier are float32"""
+    return all(w.dtype == np.float32 for w in clf.coefs_ + clf.intercepts_)
+
+
+def _float32_export(clf):
+    """Return a copy of clf to save with the MLP weights cast to float32
+    Args:
+      clf: a sklearn.neural_network.MLPClassifier or a search object whose
+           best_estimator_ is one; other objects are returned as is
+
+    Return: the object to save
+    """
+    search = clf if hasattr(clf, 'best_estimator_') else None
+    best = search.best_estimator_ if search is not None else clf
+    if not isinstance(best, MLPClassifier) or not hasattr(best, 'coefs_'):
+        return clf
+    # shallow copies so the classifier being saved isn't modified
+    best = copy.copy(best)
+    best.coefs_ = [c.astype(np.float32) for c in best.coefs_]
+    best.intercepts_ = [b.astype(np.float32) for b in best.intercepts_]
+    if search is None:
+        return best
+    search = copy.copy(search)
+    search.best_estimator_ = best
+    return search
 
 
 class MLPWrapper:
@@ -27,6 +138,9 @@ class MLPWrapper:
           recall_threshold: the threshold that the recall of one label must meet in order to be predicted
           load_from_model: load classifier from model file or not
         """
+        # float32 copies of the weights of the fitted classifier used for
+        # inference: (clf, coefs, intercepts)
+        self._weights = None
         if clf:
             self.clf = clf
         elif load_from_model:
@@ -52,6 +166,7 @@ class MLPWrapper:
           y: labels, numpy.array
         """
         self.clf.fit(X, y)
+        self._weights = None
 
     def predict_probabilities(self, X):
         """Predict probabilities of all labels for data
@@ -60,13 +175,42 @@ class MLPWrapper:
 
         Return: a list, shape (n_samples, n_classes)
         """
+        clf = getattr(self.clf, 'best_estimator_', self.clf)
+        if isinstance(clf, MLPClassifier) and hasattr(clf, 'coefs_'):
+            return mlp_predict_proba(clf, X, *self._float32_weights(clf))
         return self.clf.predict_proba(X)
 
-    def find_probability_thresholds(self, X, y, test_size=0.3):
+    def _float32_weights(self, clf):
+        """Return float32 weights of a fitted classifier
+        Embeddings are float32 so running the forward pass in float32
+        halves the memory traffic of the matrix multiplications compared
+        to sklearn, which computes in float64. Models saved by save_model
+        already have float32 weights which are used as is so memory mapped
+        weights stay shared; other models are converted once.
+        Args:
+          clf: a fitted sklearn.neural_network.MLPClassifier object
+
+        Return: (coefs, intercepts), lists of numpy.array
+        """
+        if _has_float32_weights(clf):
+            return clf.coefs_, clf.intercepts_
+        weights = self._weights
+        if weights is None or weights[0] is not clf:
+            logging.info("Converting the MLP weights to float32; save the "
+                         "model again to store float32 weights")
+            weights = (clf,
+                       [c.astype(np.float32) for c in clf.coefs_],
+                       [b.astype(np.float32) for b in clf.intercepts_])
+            self._weights = weights
+        return weights[1:]
+
+    def find_probability_thresholds(self, X, y, test_size=0.3, n_jobs=-1):
         """Split the dataset into training and testing to find probability thresholds for all labels
         Args:
           X: features, numpy.array
           y: labels, numpy.array
+          test_size: fraction of the dataset to use for testing
+          n_jobs: number of labels to process in parallel, int
         """
         # split data
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=1234)
@@ -76,19 +220,16 @@ class MLPWrapper:
         self.probability_thresholds = {}
         self.precisions = {}
         self.recalls = {}
-        self.total_labels_count = len(y_test[0])
-        for label in range(self.total_labels_count):
-            # find the probability for each label
-            best_precision, best_recall, best_threshold = 0.0, 0.0, None
-            precision, recall, threshold = precision_recall_curve(np.array(y_test)[:, label], y_pred[:, label])
-            for prec, reca, thre in zip(precision[:-1], recall[:-1], threshold):
-                # precision, recall must meet two thresholds respecitively
-                if prec >= self.precision_threshold and reca >= self.recall_threshold:
-                    # choose the threshold with the higher precision
-                    if prec > best_precision:
-                        best_precision = prec
-                        best_recall = reca
-                        best_threshold = thre
+        # convert once rather than for every label
+        y_test = np.asarray(y_test)
+        self.total_labels_count = y_test.shape[1]
+        # labels are independent so process them in parallel; threads are enough
+        # because the work is done in numpy which releases the GIL
+        results = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(find_label_threshold)(y_test[:, label], y_pred[:, label],
+                                          self.precision_threshold, self.recall_threshold)
+            for label in range(self.total_labels_count))
+        for label, (best_precision, best_recall, best_threshold) in enumerate(results):
             # self.probability_thresholds is a dict {label_index: probability_threshold}
             # If probability_thresholds[label] is None, do not predict this label always, which
             # means this label is in the excluded list because it does not satisfy
@@ -121,8 +262,10 @@ class MLPWrapper:
         """
         if model_file:
             self.model_file = model_file
-        with open(self.model_file, 'wb') as f:
-            dpickle.dump(self.clf, f)
+        # The model is saved uncompressed with float32 weights so that
+        # load_model can memory map the weights and inference can use them
+        # without making a copy.
+        joblib.dump(_float32_export(self.clf), self.model_file)
 
     def load_model(self, model_file=None):
         """Load the model from the local path
@@ -132,10 +275,19 @@ class MLPWrapper:
         """
         if model_file:
             self.model_file = model_file
+        self._weights = None
         if not os.path.exists(self.model_file):
-            raise Exception("Model path {self.model_file} does not exist")
-        with open(self.model_file, 'rb') as f:
-            self.clf = dpickle.load(f)
+            raise Exception(f"Model path {self.model_file} does not exist")
+        try:
+            # Memory map the weights so they aren't copied into memory and
+            # the pages can be shared by multiple workers.
+            self.clf = joblib.load(self.model_file, mmap_mode='r')
+        # Models saved before switching to joblib were written with dill.
+        except Exception as e:
+            logging.info(f"Could not load {self.model_file} with joblib ({e}); "
+                         f"falling back to dill")
+            with open(self.model_file, 'rb') as f:
+                self.clf = dpickle.load(f)
 
 def calculate_auc(predictions, y_holdout, label_columns):
     """Calculate AUC.
@@ -1,13 +1,22 @@
 """Define a repo specific model."""
 
+import atexit
+import functools
 import hashlib
 import logging
+import multiprocessing
 import numpy as np
 import os
 import requests
-import yaml
+import threading
+from requests import adapters
+from urllib3.util import retry
+
+from google.cloud import storage
 
 from code_intelligence import gcs_util
+from code_intelligence import util
+from label_microservice import batcher
 from label_microservice import mlp
 from label_microservice import models
 from label_microservice import repo_config
@@ -15,19 +24,133 @@ from label_microservice import repo_config
 # The default endpoint for the microservice to compute embeddings
 DEFAULT_EMBEDDING_API_ENDPOINT = "http://issue-embedding-server"
 
+# Embeddings of concurrently processed issues are stacked into a single
+# MLP forward pass of at most this many rows.
+MAX_BATCH_SIZE = 32
+MAX_BATCH_WAIT_SECS = .02
+
+# Size of the connection pool to the embedding service; this should be at
+# least the number of messages the worker processes concurrently.
+EMBEDDING_POOL_SIZE = 16
+# (connect, read) timeouts in seconds for calls to the embedding service.
+EMBEDDING_TIMEOUT = (2, 10)
+# Number of float32 values in an issue embedding.
+EMBEDDING_SIZE = 1600
+
+def _new_embedding_session():
+  """Return a session which keeps connections to the embedding service alive.
+
+  Only failures to connect are retried; since requests are POSTs we don't
+  retry once the server has received the request.
+  """
+  session = requests.Session()
+  adapter = adapters.HTTPAdapter(
+    pool_connections=EMBEDDING_POOL_SIZE, pool_maxsize=EMBEDDING_POOL_SIZE,
+    max_retries=retry.Retry(total=3, read=0, backoff_factor=.2))
+  session.mount("http://", adapter)
+  session.mount("https://", adapter)
+  return session
+
+# The GCS generation of each file we have downloaded keyed by
+# (bucket, path, local path).
+_gcs_generations = {}
+# Downloads of the same file are serialized by a lock per key; _gcs_lock
+# only guards the dictionary of locks.
+_gcs_locks = {}
+_gcs_lock = threading.Lock()
+_storage_client = None
+
+def _download_from_gcs(bucket_name, gcs_path, local_path):
+  """Download a file from GCS unless the local copy is already current."""
+  global _storage_client # pylint: disable=global-statement
+
+  # Threads racing on the first download may each create a client; that's
+  # harmless and keeps client creation out of any lock.
+  if not _storage_client:
+    _storage_client = storage.Client()
+
+  key = (bucket_name, gcs_path, local_path)
+  with _gcs_lock:
+    key_lock = _gcs_locks.setdefault(key, threading.Lock())
+
+  with key_lock:
+    _gcs_generations[key] = gcs_util.download_file_if_changed(
+      bucket_name, gcs_path, local_path,
+      generation=_gcs_generations.get(key), storage_client=_storage_client)
+
+@functools.lru_cache(maxsize=32)
+def _load_mlp(model_path, mtime_ns):
+  """Load the MLP model stored at model_path.
+
+  Models are cached keyed on the path and modification time of the file so
+  the model is only deserialized again when a new model is downloaded.
+  """
+  logging.info(f"Loading MLP model from {model_path}")
+  return mlp.MLPWrapper(clf=None, model_file=model_path, load_from_model=True)
+
+# Number of processes used to compute MLP predictions. Embedding and GitHub
+# requests are I/O bound and run on threads, but the MLP forward pass holds
+# the GIL; running it in other processes lets it scale with cores. With 0
+# predictions are computed in the worker process.
+MLP_PROCESSES = int(os.getenv("MLP_PROCESSES", "0"))
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def _get_process_pool():
+  """Return the pool of processes used to compute MLP predictions."""
+  global _process_pool # pylint: disable=global-statement
+  with _process_pool_lock:
+    if _process_pool is None:
+      # Use forkserver so the pool processes don't inherit the threads
+      # and TensorFlow state of the worker.
+      context = multiprocessing.get_context("forkserver")
+      _process_pool = context.Pool(processes=MLP_PROCESSES)
+      atexit.register(_close_process_pool)
+  return _process_pool
+
+def _close_process_pool():
+  """Shut down the pool of processes used to compute MLP predictions."""
+  global _process_pool # pylint: disable=global-statement
+  with _process_pool_lock:
+    if _process_pool is not None:
+      _process_pool.close()
+      _process_pool.join()
+      _process_pool = None
+
+def _predict_in_process(model_path, mtime_ns, embeddings):
+  """Compute label probabilities in a pool process.
+
+  Each pool process loads a model once and reuses it since _load_mlp is
+  cached; only the embeddings and probabilities cross process boundaries.
+  """
+  return _load_mlp(model_path, mtime_ns).predict_probabilities(embeddings)
+
 class RepoSpecificLabelModel(models.IssueLabelModel):
   """A repo specific model using a multi-layer perceptron."""
 
   def __init__(self):
     self.config = None
     self._mlp_predictor = None
+    # (model_path, mtime_ns) of the MLP model file; used to load the same
+    # model in the pool processes.
+    self._mlp_key = None
     self._embedding_api_endpoint = DEFAULT_EMBEDDING_API_ENDPOINT
+    self._session = _new_embedding_session()
 
     # A list of labels. The order of the labels corresponds to the order
     # of the probabilities returned by the model
     self._label_names = None
     # Dictionary mapping label names to the probability thresholds.
     self._label_thresholds = None
+    # Arrays of the label names and thresholds in the same order as
+    # the probabilities. Labels without a threshold have threshold inf.
+    self._label_array = None
+    self._thresholds = None
+
+    self._batcher = batcher.MicroBatcher(
+      self._predict_batch, max_batch_size=MAX_BATCH_SIZE,
+      max_wait_secs=MAX_BATCH_WAIT_SECS, name="repo-mlp-batcher")
 
   @classmethod
   def from_repo(cls, repo_owner, repo_name, embedding_api_endpoint=None):
@@ -50,29 +173,31 @@ class RepoSpecificLabelModel(models.IssueLabelModel):
                                           repo_name=repo_name)
 
     # download model
-    gcs_util.download_file_from_gcs(model.config.model_bucket_name,
-                                    model.config.model_gcs_path,
-                                    model.config.model_local_path)
+    _download_from_gcs(model.config.model_bucket_name,
+                       model.config.model_gcs_path,
+                       model.config.model_local_path)
 
     # download label columns
-    gcs_util.download_file_from_gcs(model.config.model_bucket_name,
-                                    model.config.labels_gcs_path,
-                                    model.config.labels_local_path)
+    _download_from_gcs(model.config.model_bucket_name,
+                       model.config.labels_gcs_path,
+                       model.config.labels_local_path)
 
-    model._mlp_predictor = mlp.MLPWrapper(
-      clf=None, model_file=model.config.model_local_path, load_from_model=True)
+    model_path = model.config.model_local_path
+    model._mlp_key = (model_path, os.stat(model_path).st_mtime_ns)
+    model._mlp_predictor = _load_mlp(*model._mlp_key)
 
     # Get label info.
     # Expect a YAML file with a dictionary
     # {'labels': list, 'probability_thresholds': {label_index: threshold}}
-    with open(model.config.labels_local_path, 'r') as f:
-      label_columns = yaml.safe_load(f)
+    label_columns = util.load_yaml_file(model.config.labels_local_path)
 
-    model._label_names = label_columns["labels"]
-    model._label_thresholds = {}
+    label_names = label_columns["labels"]
+    label_thresholds = {}
 
     for index, threshold in label_columns["probability_thresholds"].items():
-      model._label_thresholds[model._label_names[index]] = threshold
+      label_thresholds[label_names[index]] = threshold
+
+    model._set_label_thresholds(label_names, label_thresholds)
 
     logging.info(f"Loaded model gs://{model.config.model_bucket_name}/"
                  f"{model.config.model_gcs_path}")
@@ -87,6 +212,23 @@ class RepoSpecificLabelModel(models.IssueLabelModel):
     logging.info(f"Issue embedding service set to {model._embedding_api_endpoint}")
     return model
 
+  def _set_label_thresholds(self, label_names, label_thresholds):
+    """Set the labels and their probability thresholds.
+
+    Args:
+      label_names: List of labels in the same order as the probabilities
+        returned by the model.
+      label_thresholds: Dictionary mapping label names to the probability
+        threshold. A threshold of None means the label is never predicted.
+    """
+    self._label_names = label_names
+    self._label_thresholds = label_thresholds
+    self._label_array = np.array(label_names, dtype=object)
+    # if the threshold of any label is None, the label does not meet both
+    # of precision & recall thresholds so it should never be predicted.
+    self._thresholds = np.array(
+      [label_thresholds.get(l) or np.inf for l in label_names])
+
   def predict_issue_labels(self, title:str , text:str, context=None):
     """Return a dictionary of label probabilities.
 
@@ -110,14 +252,9 @@ class RepoSpecificLabelModel(models.IssueLabelModel):
       logging.error("No embeddings returned for issue", extra=context)
       return {}
 
-    # Predict probabilities expects a list of lists; i.e a 2-d matrix where
-    # each column is a different input vector. The output is an array
-    # with shape (n_samples, n_clasess) (for more info see
-    # https://scikit-learn.org/stable/modules/generated/sklearn.neural_network.MLPClassifier.html#sklearn.neural_network.MLPClassifier.predict_proba)
-    # We take the first row of this matrix because we only have 1 sample.
-    # Note: result[0] is essentially equivalent to result[0, :]
-    label_probabilities = self._mlp_predictor.predict_probabilities(
-      [issue_embedding])[0]
+    # The embedding is batched with those of other issues being processed
+    # concurrently; we get back the row of probabilities for this issue.
+    label_probabilities = self._batcher.predict(issue_embedding)
 
     # check thresholds to get labels that need to be predicted
     # TODO(kubeflow/code-intelligence/issues/83): We should store the labels
@@ -134,23 +271,43 @@ class RepoSpecificLabelModel(models.IssueLabelModel):
     extra["predictions"] = predictions
     logging.info(f"Unfiltered predictions: {predictions}", extra=extra)
 
-    labels_to_remove = []
-    for label, probability in predictions.items():
-      # if the threshold of any label is None, just ignore it
-      # because the label does not meet both of precision & recall thresholds
-      if not self._label_thresholds[label]:
-        labels_to_remove.append(label)
-        continue
-
-      if probability < self._label_thresholds[label]:
-        labels_to_remove.append(label)
-
-    for l in labels_to_remove:
-      del predictions[l]
-    logging.info(f"Labels below precision and recall {labels_to_remove}",
-                 extra=context)
+    # Labels without a threshold have threshold inf so a single comparison
+    # filters them along with the labels below their threshold.
+    idx = np.flatnonzero(label_probabilities >= self._thresholds)
+    predictions = dict(zip(self._label_array[idx].tolist(),
+                           label_probabilities[idx].tolist()))
+
+    if logging.getLogger().isEnabledFor(logging.INFO):
+      labels_to_remove = np.delete(self._label_array, idx).tolist()
+      logging.info(f"Labels below precision and recall {labels_to_remove}",
+                   extra=context)
     return predictions
 
+  def _predict_batch(self, embeddings):
+    """Compute the label probabilities for a batch of issue embeddings.
+
+    Args:
+      embeddings: List of issue embeddings.
+
+    Return
+    ------
+    list: One array of label probabilities per embedding.
+    """
+    # Predict probabilities expects a 2-d matrix where each row is a
+    # different input vector. The output is an array with shape
+    # (n_samples, n_clasess) (for more info see
+    # https://scikit-learn.org/stable/modules/generated/sklearn.neural_network.MLPClassifier.html#sklearn.neural_network.MLPClassifier.predict_proba)
+    batch = np.stack(embeddings)
+    if MLP_PROCESSES and self._mlp_key:
+      # Batches are computed one at a time by the batcher thread so split
+      # each batch across the pool processes to use all of them.
+      chunks = np.array_split(batch, min(MLP_PROCESSES, len(batch)))
+      probs = np.concatenate(_get_process_pool().starmap(
+        _predict_in_process, [(*self._mlp_key, c) for c in chunks]))
+    else:
+      probs = self._mlp_predictor.predict_probabilities(batch)
+    return list(np.asarray(probs))
+
   def _get_issue_embedding(self, title, text):
     """Get the embedding of the issue by calling GitHub Issue
     Embeddings API endpoint.
@@ -163,12 +320,20 @@ class RepoSpecificLabelModel(models.IssueLabelModel):
     ------
     numpy.ndarray
         shape: (1600,)
+      or None if the service couldn't compute the embedding.
+
+    Raises
+    ------
+    util.RetryableError: if the service returned a 5xx or 429 response.
     """
     data = {'title': title, 'body': text}
 
     # sending post request and saving response as response object
     url = self._embedding_api_endpoint + "/text"
-    r = requests.post(url=url, json=data)
+    r = self._session.post(url=url, json=data, timeout=EMBEDDING_TIMEOUT)
+    if util.is_retryable_status(r.status_code):
+      raise util.RetryableError(f"Embedding service returned status code "
+                                f"{r.status_code}")
     if r.status_code != 200:
       logging.warning(f'Status code is {r.status_code} not 200: '
                             'can not retrieve the embedding')
@@ -179,5 +344,7 @@ class RepoSpecificLabelModel(models.IssueLabelModel):
     m = hashlib.md5()
     m.update(r.content)
     logging.info(f"hash of embeddings {m.hexdigest()}")
-    embeddings = np.frombuffer(r.content, dtype='<f4')[:1600]
+    # Read the first EMBEDDING_SIZE floats as a view of the response
+    # rather than slicing a view of the whole buffer.
+    embeddings = np.frombuffer(r.content, dtype='<f4', count=EMBEDDING_SIZE)
     return embeddings
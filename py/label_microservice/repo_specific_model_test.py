@@ -1,7 +1,12 @@
 """Unittest for repo_specific_model. """
+import concurrent.futures
 import logging
+import numpy as np
+import os
 from unittest import mock
 import pytest
+import threading
+from sklearn import neural_network
 
 from label_microservice import mlp
 from label_microservice import repo_specific_model
@@ -17,11 +22,10 @@ def test_predict_labels():
   model._mlp_predictor = mock.MagicMock(spec=mlp.MLPWrapper)
   model._mlp_predictor.predict_probabilities.return_value = [[.2, .9]]
 
-  model._label_names = ["label1", "label2"]
-  model._label_thresholds = {
+  model._set_label_thresholds(["label1", "label2"], {
     "label1": .5 ,
     "label2": .5
-  }
+  })
   model._get_issue_embedding = mock.MagicMock()
   model._get_issue_embedding.return_value = [(10, 10)]
 
@@ -33,17 +37,118 @@ def test_predict_labels():
   test_util.assert_dict_equal(expected, results)
 
 
-@mock.patch("repo_specific_model.requests.post")
-def test_get_issue_embedding_not_found(mock_post):
+def test_predict_labels_no_threshold():
+  """Labels without a threshold should never be predicted."""
+  model = repo_specific_model.RepoSpecificLabelModel()
+
+  model._mlp_predictor = mock.MagicMock(spec=mlp.MLPWrapper)
+  model._mlp_predictor.predict_probabilities.return_value = [[.2, .9, .95]]
+
+  model._set_label_thresholds(["label1", "label2", "label3"], {
+    "label1": .1,
+    "label2": None,
+    "label3": .5,
+  })
+  model._get_issue_embedding = mock.MagicMock()
+  model._get_issue_embedding.return_value = [(10, 10)]
+
+  results = model.predict_issue_labels("some title", "some text")
+
+  expected = {
+    "label1": .2,
+    "label3": .95,
+  }
+  test_util.assert_dict_equal(expected, results)
+
+def test_get_issue_embedding_not_found():
   "Testing get_issue_embedding function when embedding service returns 404."""
 
   model = repo_specific_model.RepoSpecificLabelModel()
-  model._embedding_api_key = "1234abcd"
-  mock_post.return_value.status_code = 404
+  model._session = mock.MagicMock()
+  model._session.post.return_value.status_code = 404
   issue_embedding = model._get_issue_embedding("title", "text")
   # issue_embedding should be None
   assert not issue_embedding
 
+@mock.patch.object(repo_specific_model, "storage")
+@mock.patch.object(repo_specific_model.gcs_util, "download_file_if_changed")
+def test_download_from_gcs_concurrent(mock_download, mock_storage):
+  """Downloads of different files should not wait on each other."""
+  barrier = threading.Barrier(2, timeout=5)
+
+  def download(*args, **kwargs):
+    # Fails with BrokenBarrierError if the downloads are serialized.
+    barrier.wait()
+    return 1
+
+  mock_download.side_effect = download
+
+  with concurrent.futures.ThreadPoolExecutor(2) as executor:
+    futures = [executor.submit(repo_specific_model._download_from_gcs,
+                               "bucket", f"path/{i}", f"/tmp/{i}")
+               for i in range(2)]
+    for f in futures:
+      f.result()
+
+  assert repo_specific_model._gcs_generations[
+    ("bucket", "path/0", "/tmp/0")] == 1
+
+def _build_model(tmp_path):
+  """Return a RepoSpecificLabelModel with a small saved MLP."""
+  X = np.random.rand(20, 5)
+  y = np.random.choice([0, 1], size=(20, 3))
+  clf = neural_network.MLPClassifier(max_iter=20, random_state=1234)
+  clf.fit(X, y)
+
+  model_path = str(tmp_path / "model.dpkl")
+  mlp.MLPWrapper(clf=clf).save_model(model_path)
+
+  model = repo_specific_model.RepoSpecificLabelModel()
+  model._mlp_key = (model_path, os.stat(model_path).st_mtime_ns)
+  model._mlp_predictor = repo_specific_model._load_mlp(*model._mlp_key)
+  return model
+
+@mock.patch.object(repo_specific_model, "MLP_PROCESSES", 2)
+@mock.patch.object(repo_specific_model, "_get_process_pool")
+def test_predict_batch_splits_across_processes(mock_pool, tmp_path):
+  """Each batch should be split across the pool processes."""
+  model = _build_model(tmp_path)
+  mock_pool.return_value.starmap.side_effect = (
+    lambda fn, args: [fn(*a) for a in args])
+
+  embeddings = list(np.random.rand(5, 5).astype(np.float32))
+  probs = model._predict_batch(embeddings)
+
+  _, args = mock_pool.return_value.starmap.call_args[0]
+  assert [len(a[-1]) for a in args] == [3, 2]
+  # float32 results can differ in the last bit with the batch size.
+  np.testing.assert_allclose(
+    probs, model._mlp_predictor.predict_probabilities(np.stack(embeddings)),
+    rtol=1e-6)
+
+@mock.patch.object(repo_specific_model, "MLP_PROCESSES", 2)
+def test_predict_batch_in_process_pool(tmp_path):
+  model = _build_model(tmp_path)
+  embeddings = list(np.random.rand(4, 5).astype(np.float32))
+  try:
+    probs = model._predict_batch(embeddings)
+  finally:
+    repo_specific_model._close_process_pool()
+
+  assert len(probs) == 4
+  np.testing.assert_allclose(
+    probs, model._mlp_predictor.predict_probabilities(np.stack(embeddings)),
+    rtol=1e-6)
+
+@pytest.mark.parametrize("status_code", [429, 503])
+def test_get_issue_embedding_retryable(status_code):
+  model = repo_specific_model.RepoSpecificLabelModel()
+  model._session = mock.MagicMock()
+  model._session.post.return_value.status_code = status_code
+
+  with pytest.raises(repo_specific_model.util.RetryableError):
+    model._get_issue_embedding("title", "text")
+
 if __name__ == "__main__":
   logging.basicConfig(
       level=logging.INFO,
@@ -1,54 +1,249 @@
+import cachetools
+import concurrent.futures
+import fire
+import hashlib
+import json
 import logging
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
 
-from collections import defaultdict
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras import models as keras_models
-from tensorflow.keras import utils as keras_utils
 
 import dill as dpickle
 
 from urllib.request import urlopen
+from label_microservice import batcher
 from label_microservice import models
 import typing
 
+# The maximum number of preprocessed titles and bodies to cache.
+PREPROCESS_CACHE_SIZE = 4096
+
+# The probability threshold for labels without a specific threshold.
+DEFAULT_PREDICTION_THRESHOLD = .52
+
+# TODO(jlewi): We should probably parameterize the models rather than
+# hardcoding it.
+TITLE_PP_URL = "https://storage.googleapis.com/codenet/issue_labels/issue_label_model_files/title_pp.dpkl"
+BODY_PP_URL = "https://storage.googleapis.com/codenet/issue_labels/issue_label_model_files/body_pp.dpkl"
+MODEL_URL = "https://storage.googleapis.com/codenet/issue_labels/issue_label_model_files/Issue_Label_v1_best_model.hdf5"
+
+# convert_to_tflite writes the names of the Keras model inputs, in order, to
+# a file with this suffix next to the TFLite model.
+INPUT_NAMES_SUFFIX = ".inputs.json"
+
+# Directory where downloaded model artifacts are cached. Mount a volume here
+# to reuse the artifacts across restarts.
+CACHE_DIR = os.getenv("LABEL_MODEL_CACHE_DIR",
+                      os.path.join(os.path.expanduser("~"), ".cache",
+                                   "label_microservice"))
+
+# The preprocessors are loaded once per process and shared by all instances
+# of UniversalKindLabelModel.
+_preprocessors = None
+_preprocessors_lock = threading.Lock()
+
+def _fetch(url):
+  """Return a local path for url downloading it to CACHE_DIR if needed."""
+  # Prefix the file name with a digest of the url so artifacts with the same
+  # name at different urls (e.g. new model versions) don't collide.
+  digest = hashlib.blake2b(url.encode(), digest_size=8).hexdigest()
+  path = os.path.join(CACHE_DIR, f"{digest}_{os.path.basename(url)}")
+  if os.path.exists(path):
+    return path
+
+  logging.info(f"Downloading {url} to {path}")
+  os.makedirs(CACHE_DIR, exist_ok=True)
+  # Download to a temporary file and rename it so a partially downloaded
+  # file is never mistaken for a cached one.
+  fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR)
+  try:
+    with os.fdopen(fd, "wb") as dest, urlopen(url) as src:
+      shutil.copyfileobj(src, dest)
+    os.replace(temp_path, path)
+  except Exception:
+    os.remove(temp_path)
+    raise
+  return path
+
+def _load_pickle(url):
+  """Load a pickled object from url.
+
+  The stdlib unpickler is implemented in C and is much faster than dill's,
+  so try it first and only fall back to dill for objects that need it.
+  """
+  path = _fetch(url)
+  with open(path, "rb") as f:
+    try:
+      return pickle.load(f)
+    except (pickle.UnpicklingError, AttributeError, ImportError) as e:
+      logging.info(f"Could not unpickle {path} with pickle ({e}); "
+                   f"falling back to dill")
+
+    f.seek(0)
+    return dpickle.load(f)
+
+def _ensure_artifacts(model_url):
+  """Return the title preprocessor, body preprocessor and local model path.
+
+  The preprocessors are downloaded and deserialized on first use only.
+
+  Args:
+    model_url: URL of the model file.
+  """
+  global _preprocessors
+  # The artifacts are independent downloads so fetch them concurrently.
+  with _preprocessors_lock, concurrent.futures.ThreadPoolExecutor(
+    max_workers=3) as executor:
+    model_path = executor.submit(_fetch, model_url)
+    if _preprocessors is None:
+      title_pp = executor.submit(_load_pickle, TITLE_PP_URL)
+      body_pp = executor.submit(_load_pickle, BODY_PP_URL)
+      _preprocessors = (title_pp.result(), body_pp.result())
+    title_pp, body_pp = _preprocessors
+    return title_pp, body_pp, model_path.result()
+
+def _tflite_input_name(name):
+  """Return the Keras input name of a TFLite input tensor.
+
+  The TF 1.x converter names inputs after the Keras input layers; the TF 2
+  converter names them serving_default_<name>:0.
+  """
+  name = re.sub(r":\d+$", "", name)
+  prefix = "serving_default_"
+  if name.startswith(prefix):
+    name = name[len(prefix):]
+  return name
+
+class _TFLiteModel:
+  """Run a TensorFlow Lite model with the same predict interface as Keras.
+
+  The interpreter isn't thread safe so callers need to serialize calls
+  to predict.
+  """
+  def __init__(self, model_path, input_names):
+    """Load the model.
+
+    Args:
+      model_path: Path of the TFLite model.
+      input_names: Names of the inputs of the Keras model the TFLite model
+        was converted from in the order of the Keras model's inputs.
+    """
+    self._interpreter = tf.lite.Interpreter(model_path=model_path)
+    self._interpreter.allocate_tensors()
+    self._input_names = list(input_names)
+    self._output_index = self._interpreter.get_output_details()[0]["index"]
+    self._update_input_details()
+
+  def _update_input_details(self):
+    """Map the Keras input names to the details of the TFLite inputs."""
+    details = {_tflite_input_name(d["name"]): d
+               for d in self._interpreter.get_input_details()}
+    missing = [n for n in self._input_names if n not in details]
+    if missing:
+      raise ValueError(f"TFLite model has no inputs named {missing}; "
+                       f"inputs are {list(details.keys())}")
+    self._input_details = [details[n] for n in self._input_names]
+
+  def predict(self, x, batch_size=None):
+    """Return the output of the model.
+
+    Args:
+      x: List of input arrays in the same order as the inputs of the Keras
+        model the TFLite model was converted from.
+      batch_size: Ignored; the whole input is processed as a single batch.
+    """
+    resized = False
+    for detail, values in zip(self._input_details, x):
+      if tuple(detail["shape"]) != values.shape:
+        self._interpreter.resize_tensor_input(detail["index"], values.shape)
+        resized = True
+
+    if resized:
+      self._interpreter.allocate_tensors()
+      self._update_input_details()
+
+    for detail, values in zip(self._input_details, x):
+      self._interpreter.set_tensor(detail["index"],
+                                   values.astype(detail["dtype"]))
+    self._interpreter.invoke()
+    return self._interpreter.get_tensor(self._output_index)
+
 class UniversalKindLabelModel(models.IssueLabelModel):
   """UniversalKindLabelModel is a universal model that is trained across all repos.
 
   The model predicts the kind for an issue.
   """
-  def __init__(self,  class_names=['bug', 'feature', 'question']):
+  def __init__(self,  class_names=['bug', 'feature', 'question'],
+               tflite_model_url=None):
     """Instantiate the model.
 
     Args:
       class_names: The specific label names to use for the three classes.
+      tflite_model_url: (Optional) URL of a TensorFlow Lite version of the
+        model produced by convert_to_tflite. If supplied it is used instead
+        of the Keras model.
     """
     super(UniversalKindLabelModel, self).__init__()
 
-    # TODO(jlewi): We should probably parameterize the models rather than
-    # hardcoding it.
-    title_pp_url = "https://storage.googleapis.com/codenet/issue_labels/issue_label_model_files/title_pp.dpkl"
-    body_pp_url = 'https://storage.googleapis.com/codenet/issue_labels/issue_label_model_files/body_pp.dpkl'
-    model_url = 'https://storage.googleapis.com/codenet/issue_labels/issue_label_model_files/Issue_Label_v1_best_model.hdf5'
-    model_filename = 'downloaded_model.hdf5'
+    self.title_pp, self.body_pp, self._model_path = _ensure_artifacts(
+      tflite_model_url or MODEL_URL)
 
-    with urlopen(title_pp_url) as f:
-        self.title_pp = dpickle.load(f)
+    if tflite_model_url:
+      logging.info(f"Using TFLite model {tflite_model_url}")
+      self._graph = None
+      self._session = None
+      with open(_fetch(tflite_model_url + INPUT_NAMES_SUFFIX)) as f:
+        input_names = json.load(f)
+      self.model = _TFLiteModel(self._model_path, input_names)
+    else:
+      self._load_keras_model()
 
-    with urlopen(body_pp_url) as f:
-        self.body_pp = dpickle.load(f)
+    # Concurrent predictions are coalesced into a single call to the model.
+    # The batcher invokes the model from a single thread so calls to the
+    # model are serialized.
+    self._batcher = batcher.MicroBatcher(self._predict_batch,
+                                         name="universal-model-batcher")
 
-    self._model_path = keras_utils.get_file(fname=model_filename, origin=model_url)
+    # Cache the output of the preprocessors keyed by a hash of the text;
+    # the same issue is often predicted multiple times e.g. on retries.
+    self._preprocess_lock = threading.Lock()
+    self._title_cache = cachetools.LRUCache(maxsize=PREPROCESS_CACHE_SIZE)
+    self._body_cache = cachetools.LRUCache(maxsize=PREPROCESS_CACHE_SIZE)
 
-    self._graph =  None
-    self.model = None
     self.class_names = class_names
 
     # set the prediction threshold for everything except for the label question
     # which has a different threshold.
     # These values were copied from the original code.
     # https://github.com/machine-learning-apps/Issue-Label-Bot/blob/536e8bf4928b03d522dd021c0464587747e90a87/flask_app/app.py#L43
-    self._prediction_threshold = defaultdict(lambda: .52)
-    self._prediction_threshold["question"] = .60
+    self._prediction_threshold = {"question": .60}
+    # Thresholds in the same order as the model outputs so predictions can
+    # be filtered with a single comparison.
+    self._threshold_vec = np.array(
+      [self._prediction_threshold.get(c, DEFAULT_PREDICTION_THRESHOLD)
+       for c in self.class_names])
+
+  def _load_keras_model(self):
+    """Load the Keras model once into its own graph and session.
+
+    Using an explicit graph and session rather than the defaults means the
+    model can be used from threads other than the one that created it.
+    """
+    # TODO(https://github.com/kubeflow/code-intelligence/issues/89): We
+    # previously reloaded the model on every predict call to work around
+    # threading issues.
+    self._graph = tf.Graph()
+    with self._graph.as_default():
+      self._session = tf.compat.v1.Session(graph=self._graph)
+      with self._session.as_default():
+        self.model = keras_models.load_model(self._model_path)
 
   def predict_issue_labels(self, org:str, repo:str, title:str,
                            text:typing.List[str], context=None):
@@ -77,34 +272,119 @@ class UniversalKindLabelModel(models.IssueLabelModel):
     if not context:
       context = {}
     #transform raw text into array of ints
-    vec_body = self.body_pp.transform(["\n".join(text)])
-    vec_title = self.title_pp.transform([title])
+    vec_body = self._transform(self.body_pp, self._body_cache, text)
+    vec_title = self._transform(self.title_pp, self._title_cache, [title])
 
     # make predictions with the model
-    # TODO(jlewi): Is this right? Do we want to get the default graph or
-    # create a new graph? What happens when we are loading multiple graphs
-    # at once into memory.
-    # TODO(https://github.com/kubeflow/code-intelligence/issues/89): As
-    # hack for threading issues reload the model on each predict call.
-    self._graph =  tf.Graph()
-    with self._graph.as_default():
-      self.model = keras_models.load_model(self._model_path)
-      probs = self.model.predict(x=[vec_body, vec_title]).tolist()[0]
-
-    results = {}
+    probs = self._batcher.predict((vec_body, vec_title))
 
-    raw = dict(zip(self.class_names, probs))
-    # Lets log the full probabilities
-    extra = {
-      "predictions": raw,
-    }
-    extra.update(context)
+    above_threshold = probs >= self._threshold_vec
+    probs = probs.tolist()
 
-    for label, p in raw.items():
-      if p < self._prediction_threshold[label]:
-        continue
-      results[label] = p
+    results = {label: p for label, p, keep
+               in zip(self.class_names, probs, above_threshold) if keep}
 
-    extra["labels"] = list(results.keys())
-    logging.info("Universal model predictions.", extra=extra)
+    # Only build the log payload if it will actually be emitted.
+    if logging.getLogger().isEnabledFor(logging.INFO):
+      # Lets log the full probabilities
+      extra = {
+        "predictions": dict(zip(self.class_names, probs)),
+      }
+      extra.update(context)
+      extra["labels"] = list(results.keys())
+      logging.info("Universal model predictions.", extra=extra)
     return results
+
+  def _transform(self, pp, cache, pieces):
+    """Transform a document with a preprocessor caching the result.
+
+    The document is the newline separated concatenation of pieces. The cache
+    key is computed by hashing the pieces incrementally so the document only
+    needs to be built on a cache miss.
+
+    Args:
+      pp: The preprocessor.
+      cache: The cache for this preprocessor.
+      pieces: List of strings making up the document.
+
+    Returns:
+      A read only array with shape (1, sequence_length).
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for i, piece in enumerate(pieces):
+      if i:
+        digest.update(b"\n")
+      digest.update(piece.encode("utf-8", "ignore"))
+    key = digest.digest()
+
+    with self._preprocess_lock:
+      vec = cache.get(key)
+
+    if vec is None:
+      vec = pp.transform(["\n".join(pieces)])
+      # The array is shared between callers so make sure it isn't modified.
+      vec.setflags(write=False)
+      with self._preprocess_lock:
+        cache[key] = vec
+
+    return vec
+
+  def _predict_batch(self, items):
+    """Generate predictions for a batch of issues.
+
+    Args:
+      items: List of (vec_body, vec_title) tuples as returned by the
+        preprocessors; each array has shape (1, sequence_length).
+
+    Returns:
+      List of arrays with the probability of each class for each item.
+    """
+    vec_body = np.concatenate([body for body, _ in items])
+    vec_title = np.concatenate([title for _, title in items])
+    if self._graph is None:
+      probs = self.model.predict(x=[vec_body, vec_title],
+                                 batch_size=len(items))
+    else:
+      with self._graph.as_default(), self._session.as_default():
+        probs = self.model.predict(x=[vec_body, vec_title],
+                                   batch_size=len(items))
+    return list(probs)
+
+def convert_to_tflite(keras_model_path, output_path):
+  """Convert the Keras model to a quantized TensorFlow Lite model.
+
+  The conversion uses post training dynamic range quantization; weights
+  are stored as int8 and activations are computed in floating point. The
+  result can be served by passing its URL as tflite_model_url to
+  UniversalKindLabelModel; the file with the input names written next to
+  it must be uploaded alongside it.
+
+  Args:
+    keras_model_path: Path of the HDF5 Keras model.
+    output_path: Path to write the TFLite model to.
+  """
+  model = keras_models.load_model(keras_model_path)
+  input_names = [t.name.split(":")[0] for t in model.inputs]
+  # TF 1.x only supports converting a saved Keras model file.
+  if hasattr(tf.lite.TFLiteConverter, "from_keras_model"):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+  else:
+    converter = tf.lite.TFLiteConverter.from_keras_model_file(
+      keras_model_path)
+  converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  tflite_model = converter.convert()
+
+  with open(output_path, "wb") as hf:
+    hf.write(tflite_model)
+  with open(output_path + INPUT_NAMES_SUFFIX, "w") as hf:
+    json.dump(input_names, hf)
+  logging.info(f"Wrote TFLite model to {output_path}")
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO,
+                      format=('%(levelname)s|%(asctime)s'
+                              '|%(message)s|%(pathname)s|%(lineno)d|'),
+                      datefmt='%Y-%m-%dT%H:%M:%S',
+                      )
+
+  fire.Fire(convert_to_tflite)
@@ -0,0 +1,103 @@
+"""Unittest for universal_kind_label_model."""
+import json
+import logging
+import numpy as np
+import os
+import pytest
+from unittest import mock
+
+tf = pytest.importorskip("tensorflow")
+
+from label_microservice import universal_kind_label_model
+
+def test_fetch_removes_partial_download(tmp_path):
+  src = mock.MagicMock()
+  src.__enter__.return_value.read.side_effect = IOError("connection reset")
+
+  with mock.patch.object(universal_kind_label_model, "CACHE_DIR",
+                         str(tmp_path)), \
+       mock.patch.object(universal_kind_label_model, "urlopen",
+                         return_value=src):
+    with pytest.raises(IOError):
+      universal_kind_label_model._fetch("https://example.com/model.hdf5")
+
+  assert os.listdir(str(tmp_path)) == []
+
+def test_fetch_keys_cache_on_url(tmp_path):
+  def _urlopen(url):
+    src = mock.MagicMock()
+    src.__enter__.return_value.read.side_effect = [url.encode(), b""]
+    return src
+
+  with mock.patch.object(universal_kind_label_model, "CACHE_DIR",
+                         str(tmp_path)), \
+       mock.patch.object(universal_kind_label_model, "urlopen",
+                         side_effect=_urlopen):
+    v1 = universal_kind_label_model._fetch("https://example.com/v1/model.tflite")
+    v2 = universal_kind_label_model._fetch("https://example.com/v2/model.tflite")
+
+  assert v1 != v2
+  assert v1.endswith("model.tflite")
+  with open(v2) as f:
+    assert f.read() == "https://example.com/v2/model.tflite"
+
+def _build_keras_model(model_path):
+  """Build and save a small Keras model with two inputs of the same shape.
+
+  The inputs have the same shape so feeding them in the wrong order
+  changes the outputs rather than raising an error.
+  """
+  body = tf.keras.Input(shape=(4,), name="Body-Input")
+  title = tf.keras.Input(shape=(4,), name="Title-Input")
+  hidden = tf.keras.layers.Concatenate()([
+    tf.keras.layers.Dense(8, activation="relu")(body),
+    tf.keras.layers.Dense(2, activation="relu")(title)])
+  output = tf.keras.layers.Dense(3, activation="softmax")(hidden)
+  model = tf.keras.Model([body, title], output)
+  model.save(model_path)
+  return model
+
+@pytest.mark.parametrize("batch_size", [1, 5])
+def test_tflite_model_matches_keras(tmp_path, batch_size):
+  keras_path = str(tmp_path / "model.h5")
+  tflite_path = str(tmp_path / "model.tflite")
+  model = _build_keras_model(keras_path)
+
+  universal_kind_label_model.convert_to_tflite(keras_path, tflite_path)
+
+  with open(tflite_path + universal_kind_label_model.INPUT_NAMES_SUFFIX) as f:
+    input_names = json.load(f)
+  assert input_names == ["Body-Input", "Title-Input"]
+
+  tflite_model = universal_kind_label_model._TFLiteModel(tflite_path,
+                                                        input_names)
+
+  x = [np.random.rand(batch_size, 4).astype(np.float32) * 10,
+       np.random.rand(batch_size, 4).astype(np.float32)]
+  expected = model.predict(x, batch_size=batch_size)
+  actual = tflite_model.predict(x, batch_size=batch_size)
+
+  assert actual.shape == (batch_size, 3)
+  # The weights are quantized to int8.
+  np.testing.assert_allclose(actual, expected, atol=.02)
+
+def test_tflite_model_missing_input(tmp_path):
+  keras_path = str(tmp_path / "model.h5")
+  tflite_path = str(tmp_path / "model.tflite")
+  _build_keras_model(keras_path)
+  universal_kind_label_model.convert_to_tflite(keras_path, tflite_path)
+
+  with pytest.raises(ValueError):
+    universal_kind_label_model._TFLiteModel(tflite_path,
+                                            ["Body-Input", "Other-Input"])
+
+if __name__ == "__main__":
+  logging.basicConfig(
+      level=logging.INFO,
+      format=('%(levelname)s|%(asctime)s'
+              '|%(pathname)s|%(lineno)d| %(message)s'),
+      datefmt='%Y-%m-%dT%H:%M:%S',
+  )
+  logging.getLogger().setLevel(logging.INFO)
+
+  pytest.main()
@@ -1,10 +1,18 @@
+import cachetools
+import concurrent.futures
+import datetime
 import os
 import fire
 import json
+import requests
+import threading
 import traceback
 
 from oauth2client.client import GoogleCredentials
+from github3 import exceptions as github3_exceptions
+from google.api_core import exceptions as api_exceptions
 from google.cloud import pubsub
+from google.cloud.pubsub_v1.subscriber import scheduler as pubsub_scheduler
 import logging
 from label_microservice.repo_config import RepoConfig
 from code_intelligence import github_app
@@ -18,6 +26,7 @@ from tensorflow import errors as tf_errors
 import retrying
 import subprocess
 import sys
+import time
 
 DEFAULT_APP_URL = "https://label-bot-prod.mlbot.net/"
 
@@ -31,6 +40,54 @@ ORG_CONFIG_REPO = ".github"
 # that we are acting as so we should be able to get the login
 LABEL_BOT_LOGINS = ["kf-label-bot-dev", "issue-label-bot"]
 
+# The number of messages to process concurrently. Handling a message is
+# dominated by network calls (GitHub, GCS, the embedding service) so
+# processing several at once increases throughput.
+DEFAULT_MAX_CONCURRENT_MESSAGES = 16
+
+# How long to reuse the IssueLabelBot config fetched from GitHub. The config
+# rarely changes so picking up changes within a few minutes is fine.
+YAML_CACHE_TTL_SECONDS = 300
+YAML_CACHE_SIZE = 1024
+
+# Errors which are likely transient; messages that fail with them are
+# redelivered rather than dropped.
+RETRYABLE_ERRORS = (util.RetryableError,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    github3_exceptions.ServerError,
+                    github3_exceptions.ConnectionError,
+                    api_exceptions.ServiceUnavailable)
+# Messages are only retried until they are this old so a persistent outage
+# can't keep redelivering them forever.
+MAX_RETRY_AGE_SECONDS = 30 * 60
+# The number of failing messages whose attempt counts are tracked.
+MAX_TRACKED_RETRY_MESSAGES = 1024
+# How long to wait before nacking a message that failed with a retryable
+# error. Pubsub redelivers nacked messages immediately so this backs off
+# retries; the delay doubles with each attempt seen by this worker.
+RETRY_DELAY_SECONDS = 1
+MAX_RETRY_DELAY_SECONDS = 60
+
+# Templates for the comments the bot adds to issues.
+LABELS_MESSAGE_TEMPLATE = "\n".join([
+    "Issue-Label Bot is automatically applying the labels:",
+    "",
+    "| Label  | Probability |",
+    "| ------------- | ------------- |",
+    "{rows}",
+    "",
+    "Please mark this comment with :thumbsup: or :thumbsdown: "
+    "to give our bot feedback! ",
+    "Links: [app homepage](https://github.com/marketplace/issue-label-bot), "
+    "[dashboard]({app_url}data/{repo_owner}/{repo_name}) and "
+    "[code](https://github.com/hamelsmu/MLapp) for this bot.",
+])
+
+NOT_CONFIDENT_MESSAGE_TEMPLATE = """Issue Label Bot is not confident enough to auto-label this issue.
+                See [dashboard]({app_url}data/{repo_owner}/{repo_name}) for more details.
+                """
+
 class Worker:
     """
     The worker class aims to do label prediction for issues from github repos.
@@ -44,7 +101,8 @@ class Worker:
     def __init__(self,
                  project_id='issue-label-bot-dev',
                  topic_name='event_queue',
-                 subscription_name='subscription_for_event_queue',):
+                 subscription_name='subscription_for_event_queue',
+                 max_concurrent_messages=DEFAULT_MAX_CONCURRENT_MESSAGES):
         """
         Initialize the parameters and GitHub app.
         Args:
@@ -52,10 +110,13 @@ class Worker:
           topic_name: pubsub topic name, str
           subscription_name: pubsub subscription name, str
           embedding_api_endpoint: endpoint of embedding api microservice, str
+          max_concurrent_messages: number of messages to process
+            concurrently, int
         """
         self.project_id = project_id
         self.topic_name = topic_name
         self.subscription_name = subscription_name
+        self.max_concurrent_messages = int(max_concurrent_messages)
 
         # This is only used in the issue comment.
         self.app_url = os.getenv("APP_URL", DEFAULT_APP_URL)
@@ -64,6 +125,16 @@ class Worker:
         self.create_subscription_if_not_exists()
 
         self._predictor = None
+        self._predictor_lock = threading.Lock()
+
+        self._yaml_cache = cachetools.TTLCache(maxsize=YAML_CACHE_SIZE,
+                                               ttl=YAML_CACHE_TTL_SECONDS)
+        self._yaml_cache_lock = threading.Lock()
+
+        # Number of failed attempts to handle a message keyed by message id.
+        self._attempts = cachetools.TTLCache(maxsize=MAX_TRACKED_RETRY_MESSAGES,
+                                             ttl=MAX_RETRY_AGE_SECONDS)
+        self._attempts_lock = threading.Lock()
 
     @classmethod
     def subscribe_from_env(cls):
@@ -80,7 +151,10 @@ class Worker:
                              f"{','.join(required)}")
         worker = Worker(project_id=os.getenv("PROJECT"),
                         topic_name=os.getenv("ISSUE_EVENT_TOPIC"),
-                        subscription_name=os.getenv("ISSUE_EVENT_SUBSCRIPTION"))
+                        subscription_name=os.getenv("ISSUE_EVENT_SUBSCRIPTION"),
+                        max_concurrent_messages=os.getenv(
+                            "MAX_CONCURRENT_MESSAGES",
+                            DEFAULT_MAX_CONCURRENT_MESSAGES))
         worker.subscribe()
 
         return worker
@@ -116,125 +190,18 @@ class Worker:
         subscription_path = subscriber.subscription_path(self.project_id,
                                                          self.subscription_name)
 
-        def callback(message):
-            """
-            Address events in pubsub by sequential procedures.
-            Load the model mapped to the events.
-            Do label prediction.
-            Add labels if the confidence is enough.
-            Args:
-              Object:
-              message =
-                  Message {
-                      data: b'New issue.',
-                      attributes: {
-                          'installation_id': '10000',
-                          'repo_owner': 'kubeflow',
-                          'repo_name': 'examples',
-                          'issue_num': '1'
-                      }
-                  }
-            """
-            if self._predictor is None:
-                # We load the models here and not in __init__ because we
-                # need to create the TensorFlow models inside the thread used
-                # by pubsub for the callbacks. If we load them in __init__
-                # they get created in a different thread and TF will return
-                # errors when trying to use the models in a different thread.
-                logging.info("Creating predictor")
-                self._predictor = issue_label_predictor.IssueLabelPredictor()
-
-            # The code that publishes the message is:
-            # https://github.com/machine-learning-apps/Issue-Label-Bot/blob/26d8fb65be3b39de244c4be9e32b2838111dac10/flask_app/forward_utils.py#L57
-            # The front end does have access to the title and body
-            # but its not being sent right now.
-            # TODO(jlewi): It looks like the log statement ends up generating
-            # multiple entries in stackdriver; i.e. the payload of the message
-            # causes the message to be spread across multiple lines. That's
-            # Not what we want.
-            logging.info(f"Recieved message {message}")
-            installation_id = message.attributes['installation_id']
-            repo_owner = message.attributes['repo_owner']
-            repo_name = message.attributes['repo_name']
-            issue_num = message.attributes['issue_num']
-
-            # log the prediction, which will be used to track the performance
-            # TODO(https://github.com/kubeflow/code-intelligence/issues/79)
-            # Ensure we capture the information needed to measure performance
-            # in stackdriver
-            log_dict = {
-                'repo_owner': repo_owner,
-                'repo_name': repo_name,
-                'issue_num': int(issue_num),
-            }
-
-            data = {
-                "repo_owner": repo_owner,
-                "repo_name": repo_name,
-                "issue_num": issue_num,
-            }
-            try:
-                predictions = self._predictor.predict(data)
-                log_dict['predictions'] = predictions
-                self.add_labels_to_issue(installation_id, repo_owner, repo_name,
-                                         issue_num, predictions)
-                # I think this log message is used for analysis.
-                logging.info("Add labels to issue.", extra=log_dict)
-
-            # TODO(jlewi): I observed cases where some of the initial inferences
-            # would succeed but on subsequent ones it started failing
-            # see: https://github.com/kubeflow/code-intelligence/issues/70#issuecomment-570491289
-            # Restarting is a bit of a hack. We should try to figure out
-            # why its happening and fix it.
-            except tf_errors.FailedPreconditionError as e:
-                logging.fatal(f"Exception occurred while handling issue "
-                              f"{repo_owner}/{repo_name}#{issue_num}. \n"
-                              f"Exception: {e}\n"
-                              f"{traceback.format_exc()}\n."
-                              f"This usually indicates an issue with "
-                              f"trying to use the model in a thread different "
-                              f"from the one it was created in. "
-                              f"The program will restart to try to recover.",
-                              extra=log_dict)
-                sys.exit(1)
-
-            # TODO(jlewi): I observed cases where some of the initial inferences
-            # would succeed but on subsequent ones it started failing
-            # see: https://github.com/kubeflow/code-intelligence/issues/70#issuecomment-570491289
-            # Restarting is a bit of a hack. We should try to figure out
-            # why its happening and fix it.
-            except tf_errors.FailedPreconditionError as e:
-                logging.fatal(f"Exception occurred while handling issue "
-                              f"{repo_owner}/{repo_name}#{issue_num}. \n"
-                              f"Exception: {e}\n"
-                              f"{traceback.format_exc()}\n."
-                              f"This usually indicates an issue with "
-                              f"trying to use the model in a thread different "
-                              f"from the one it was created in. "
-                              f"The program will restart to try to recover.")
-                sys.exit(1)
-
-            #TODO(jlewi): We should catch a more narrow exception.
-            # On exception if we don't ack the message then we risk problems
-            # caused by poison pills repeatedly crashing our workers
-            # and preventing progress.
-            except Exception as e:
-                # hard to find out which errors should be handled differently (e.g., retrying for multiple times)
-                # and how to handle the error that the same message causes for multiple times
-                # so use generic exception to ignore all errors for now
-                logging.error(f"Exception occurred while handling issue "
-                              f"{repo_owner}/{repo_name}#{issue_num}. \n"
-                              f"Exception: {e}\n"
-                              f"{traceback.format_exc()}", extra=log_dict)
-
-            # acknowledge the message, or pubsub will repeatedly attempt to deliver it
-            message.ack()
-
-        # limit the subscriber to only have one outstanding message at a time
-        flow_control = pubsub.types.FlowControl(max_messages=1)
-        future = subscriber.subscribe(subscription_path,
-                                      callback=callback,
-                                      flow_control=flow_control)
+        # Messages are independent so process several of them at once on
+        # our own thread pool; pubsub dispatches callbacks to the pool.
+        flow_control = pubsub.types.FlowControl(
+            max_messages=self.max_concurrent_messages)
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_concurrent_messages,
+            thread_name_prefix="label-worker")
+        future = subscriber.subscribe(
+            subscription_path,
+            callback=self._process_message,
+            flow_control=flow_control,
+            scheduler=pubsub_scheduler.ThreadScheduler(executor=executor))
 
         # Calling future.result will block forever. future.cancel can be called
         # to interrupt it.
@@ -246,6 +213,141 @@ class Worker:
         except KeyboardInterrupt:
             logging.info(future.cancel())
 
+    def _process_message(self, message):
+        """
+        Address events in pubsub by sequential procedures.
+        Load the model mapped to the events.
+        Do label prediction.
+        Add labels if the confidence is enough.
+        Args:
+          Object:
+          message =
+              Message {
+                  data: b'New issue.',
+                  attributes: {
+                      'installation_id': '10000',
+                      'repo_owner': 'kubeflow',
+                      'repo_name': 'examples',
+                      'issue_num': '1'
+                  }
+              }
+        """
+        predictor = self._get_predictor()
+
+        # The code that publishes the message is:
+        # https://github.com/machine-learning-apps/Issue-Label-Bot/blob/26d8fb65be3b39de244c4be9e32b2838111dac10/flask_app/forward_utils.py#L57
+        # The front end does have access to the title and body
+        # but its not being sent right now.
+        # TODO(jlewi): It looks like the log statement ends up generating
+        # multiple entries in stackdriver; i.e. the payload of the message
+        # causes the message to be spread across multiple lines. That's
+        # Not what we want.
+        logging.info("Recieved message %s", message)
+        installation_id = message.attributes['installation_id']
+        repo_owner = message.attributes['repo_owner']
+        repo_name = message.attributes['repo_name']
+        issue_num = message.attributes['issue_num']
+
+        # log the prediction, which will be used to track the performance
+        # TODO(https://github.com/kubeflow/code-intelligence/issues/79)
+        # Ensure we capture the information needed to measure performance
+        # in stackdriver
+        log_dict = {
+            'repo_owner': repo_owner,
+            'repo_name': repo_name,
+            'issue_num': int(issue_num),
+        }
+
+        data = {
+            "repo_owner": repo_owner,
+            "repo_name": repo_name,
+            "issue_num": issue_num,
+        }
+        try:
+            predictions = predictor.predict(data)
+            log_dict['predictions'] = predictions
+            self.add_labels_to_issue(installation_id, repo_owner, repo_name,
+                                     issue_num, predictions)
+            # I think this log message is used for analysis.
+            logging.info("Add labels to issue.", extra=log_dict)
+
+        # TODO(jlewi): I observed cases where some of the initial inferences
+        # would succeed but on subsequent ones it started failing
+        # see: https://github.com/kubeflow/code-intelligence/issues/70#issuecomment-570491289
+        # Restarting is a bit of a hack. We should try to figure out
+        # why its happening and fix it.
+        except tf_errors.FailedPreconditionError as e:
+            logging.fatal(f"Exception occurred while handling issue "
+                          f"{repo_owner}/{repo_name}#{issue_num}. \n"
+                          f"Exception: {e}\n"
+                          f"{traceback.format_exc()}\n."
+                          f"This usually indicates an issue with "
+                          f"trying to use the model in a thread different "
+                          f"from the one it was created in. "
+                          f"The program will restart to try to recover.",
+                          extra=log_dict)
+            sys.exit(1)
+
+        # Errors talking to the embedding service, GitHub or GCP are
+        # usually transient so let pubsub redeliver the message rather than
+        # dropping the issue.
+        except RETRYABLE_ERRORS:
+            if self._retry_message(message):
+                logging.exception("Transient error while handling issue "
+                                  "%s/%s#%s; the message will be "
+                                  "redelivered.", repo_owner, repo_name,
+                                  issue_num, extra=log_dict)
+                message.nack()
+                return
+            logging.exception("Transient error while handling issue "
+                              "%s/%s#%s; giving up since the message was "
+                              "published over %s seconds ago.", repo_owner,
+                              repo_name, issue_num, MAX_RETRY_AGE_SECONDS,
+                              extra=log_dict)
+
+        # On other exceptions if we don't ack the message then we risk
+        # problems caused by poison pills repeatedly crashing our workers
+        # and preventing progress.
+        except Exception: # pylint: disable=broad-except
+            logging.exception("Exception occurred while handling issue "
+                              "%s/%s#%s.", repo_owner, repo_name, issue_num,
+                              extra=log_dict)
+
+        # acknowledge the message, or pubsub will repeatedly attempt to deliver it
+        message.ack()
+
+    def _retry_message(self, message):
+        """Return whether to retry a message that failed with a transient error.
+
+        If the message should be retried this waits before returning to
+        back off retries.
+
+        Args:
+          message: The pubsub message.
+        """
+        age = datetime.datetime.now(datetime.timezone.utc) - message.publish_time
+        if age.total_seconds() > MAX_RETRY_AGE_SECONDS:
+            return False
+
+        with self._attempts_lock:
+            attempts = self._attempts.get(message.message_id, 0)
+            self._attempts[message.message_id] = attempts + 1
+
+        time.sleep(min(RETRY_DELAY_SECONDS * 2 ** attempts,
+                       MAX_RETRY_DELAY_SECONDS))
+        return True
+
+    def _get_predictor(self):
+        """Return the predictor creating it on first use."""
+        with self._predictor_lock:
+            if self._predictor is None:
+                # We load the models here and not in __init__ so that they
+                # are created by the threads used to process messages
+                # rather than the main thread.
+                logging.info("Creating predictor")
+                self._predictor = issue_label_predictor.IssueLabelPredictor()
+            return self._predictor
+
     # TODO(jlewi): We should refactor this to make it easier to unittest and
     # add an appropriate unittest.
     @staticmethod
@@ -269,14 +371,14 @@ class Worker:
         filtered.update(predictions)
 
         if not repo_config:
-            logging.info("No repo specific config found for "
-                         f"{repo_owner}/{repo_name}")
+            logging.info("No repo specific config found for %s/%s",
+                         repo_owner, repo_name)
             return filtered
 
         # Alias any labels.
         if "label-alias" in repo_config:
-            logging.info(f"Applying label aliases for "
-                         f"{repo_owner}/{repo_config}")
+            logging.info("Applying label aliases for %s/%s",
+                         repo_owner, repo_name)
             for old, new in repo_config["label-alias"].items():
                 if old in filtered:
                     filtered[new] = filtered[old]
@@ -291,11 +393,45 @@ class Worker:
                 if not k in allowed:
                     del filtered[k]
         else:
-            logging.info(f'{repo_owner}/{repo_name} config file does not contain `predicted-labels`, '
-                         f'bot will predict all labels with enough confidence')
+            logging.info('%s/%s config file does not contain `predicted-labels`, '
+                         'bot will predict all labels with enough confidence',
+                         repo_owner, repo_name)
 
         return filtered
 
+    def _get_yaml(self, owner, repo, ghapp):
+        """Get the IssueLabelBot config for a repo using a TTL cache.
+
+        Only successful fetches are cached. Retryable errors are raised so
+        the message is redelivered rather than labeled without the config;
+        for other failures None is returned and the next message tries again.
+
+        Args:
+          owner: repo owner
+          repo: repo name
+          ghapp: GitHubApp used to fetch the config on a cache miss
+        """
+        key = (owner, repo)
+        with self._yaml_cache_lock:
+            # The config is None if the repo doesn't have one; cache that
+            # as well.
+            if key in self._yaml_cache:
+                return self._yaml_cache[key]
+
+        try:
+            config = github_util.get_yaml(owner=owner, repo=repo, ghapp=ghapp,
+                                          raise_errors=True)
+        except RETRYABLE_ERRORS:
+            raise
+        except Exception as e: # pylint: disable=broad-except
+            logging.warning("Could not get the config for %s/%s: %s",
+                            owner, repo, e)
+            return None
+
+        with self._yaml_cache_lock:
+            self._yaml_cache[key] = config
+        return config
+
     def add_labels_to_issue(self, installation_id, repo_owner, repo_name,
                             issue_num, predictions):
         """
@@ -315,13 +451,9 @@ class Worker:
 
         # Load IssueLabelBot config. Look for both organization configuration
         # and repo specific configuration.
-        # TODO(jlewi): We should really cache these and use some form of
-        # expiration to pick up changes.
-        org_config = github_util.get_yaml(owner=repo_owner,
-                                          repo=ORG_CONFIG_REPO, ghapp=ghapp)
+        org_config = self._get_yaml(repo_owner, ORG_CONFIG_REPO, ghapp)
 
-        repo_config = github_util.get_yaml(owner=repo_owner, repo=repo_name,
-                                           ghapp=ghapp)
+        repo_config = self._get_yaml(repo_owner, repo_name, ghapp)
 
         context = {
             "repo_owner": repo_owner,
@@ -388,33 +520,23 @@ class Worker:
         # TODO(jlewi): We should Use GraphQL so we can use a single library.
         issue = install.issue(repo_owner, repo_name, issue_num)
 
+        message_args = {
+            "app_url": self.app_url,
+            "repo_owner": repo_owner,
+            "repo_name": repo_name,
+        }
         message = None
         if label_names:
-            # create message
-            # Create a markdown table with probabilities.
-            rows = ["| Label  | Probability |",
-                    "| ------------- | ------------- |"]
-
-            for l in label_names:
-                rows.append("| {} | {:.2f} |".format(l, predictions[l]))
-
-            lines = ["Issue-Label Bot is automatically applying the labels:",
-                     ""]
-            lines.extend(rows)
-            lines.append("")
-            lines.append("Please mark this comment with :thumbsup: or :thumbsdown: "
-                         "to give our bot feedback! ")
-            lines.append("Links: [app homepage](https://github.com/marketplace/issue-label-bot), "
-                         "[dashboard]({app_url}data/{repo_owner}/{repo_name}) and "
-                         "[code](https://github.com/hamelsmu/MLapp) for this bot.".format(
-                             app_url=self.app_url,
-                             repo_owner=repo_owner,
-                             repo_name=repo_name))
-            message = "\n".join(lines)
+            # create message with a markdown table of the probabilities.
+            rows = "\n".join(f"| {l} | {predictions[l]:.2f} |"
+                             for l in label_names)
+            message_args["rows"] = rows
+            message = LABELS_MESSAGE_TEMPLATE.format_map(message_args)
             # label the issue using the GitHub api
             issue.add_labels(*label_names)
             context["labels"] = label_names
-            logging.info(f'Add `{"`, `".join(label_names)}` to the issue # {issue_num}', extra=context)
+            logging.info('Add `%s` to the issue # %s', '`, `'.join(label_names),
+                         issue_num, extra=context)
         else:
             # We don't want a spam an issue with comments. So once label
             # bot comments on an issue we will not chime in to report that
@@ -424,12 +546,10 @@ class Worker:
                 # platform? Maybe we should include top predictions for
                 # all areas? The problem is the model only returns predictions
                 # above the threshold.
-                message = """Issue Label Bot is not confident enough to auto-label this issue.
-                See [dashboard]({app_url}data/{repo_owner}/{repo_name}) for more details.
-                """.format(app_url=self.app_url,
-                           repo_owner=repo_owner,
-                           repo_name=repo_name)
-                logging.warning(f'Not confident enough to label this issue: # {issue_num}', extra=context)
+                message = NOT_CONFIDENT_MESSAGE_TEMPLATE.format_map(
+                    message_args)
+                logging.warning('Not confident enough to label this issue: # %s',
+                                issue_num, extra=context)
 
         # make a comment using the GitHub api
         if message:
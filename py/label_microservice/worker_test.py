@@ -0,0 +1,128 @@
+"""Unittest for worker. """
+import datetime
+import logging
+from unittest import mock
+import pytest
+import requests
+
+from github3 import exceptions as github3_exceptions
+from google.api_core import exceptions as api_exceptions
+
+from code_intelligence import util
+from label_microservice import worker
+
+@pytest.fixture
+def label_worker():
+  with mock.patch.object(worker.Worker, "create_subscription_if_not_exists"):
+    yield worker.Worker()
+
+@mock.patch.object(worker.github_util, "get_yaml")
+def test_get_yaml_does_not_cache_failures(mock_get_yaml, label_worker):
+  config = {"predicted-labels": ["bug"]}
+  mock_get_yaml.side_effect = [Exception("GitHub timed out"), config]
+  ghapp = mock.MagicMock()
+
+  # A failed request shouldn't be treated as the repo not having a config
+  # for the lifetime of the cache.
+  assert label_worker._get_yaml("kubeflow", "kubeflow", ghapp) is None
+  assert label_worker._get_yaml("kubeflow", "kubeflow", ghapp) == config
+
+  # Successful fetches are cached.
+  assert label_worker._get_yaml("kubeflow", "kubeflow", ghapp) == config
+  assert mock_get_yaml.call_count == 2
+
+@mock.patch.object(worker.github_util, "get_yaml")
+def test_get_yaml_raises_retryable_errors(mock_get_yaml, label_worker):
+  config = {"predicted-labels": ["bug"]}
+  mock_get_yaml.side_effect = [requests.exceptions.ConnectionError(), config]
+  ghapp = mock.MagicMock()
+
+  # Labeling without the config would ignore the repo's allow list so
+  # transient failures should cause the message to be retried.
+  with pytest.raises(requests.exceptions.ConnectionError):
+    label_worker._get_yaml("kubeflow", "kubeflow", ghapp)
+  assert label_worker._get_yaml("kubeflow", "kubeflow", ghapp) == config
+
+@mock.patch.object(worker.github_util, "get_yaml")
+def test_get_yaml_caches_missing_config(mock_get_yaml, label_worker):
+  mock_get_yaml.return_value = None
+  ghapp = mock.MagicMock()
+
+  assert label_worker._get_yaml("kubeflow", "kubeflow", ghapp) is None
+  assert label_worker._get_yaml("kubeflow", "kubeflow", ghapp) is None
+  assert mock_get_yaml.call_count == 1
+
+def _message(age_seconds=0):
+  """Return a mock pubsub message published age_seconds ago."""
+  message = mock.MagicMock()
+  message.message_id = "1234"
+  message.attributes = {
+    "installation_id": "10000",
+    "repo_owner": "kubeflow",
+    "repo_name": "examples",
+    "issue_num": "1",
+  }
+  message.publish_time = (datetime.datetime.now(datetime.timezone.utc) -
+                          datetime.timedelta(seconds=age_seconds))
+  return message
+
+def _github3_server_error():
+  response = mock.MagicMock(status_code=503)
+  response.json.return_value = {"message": "unavailable"}
+  return github3_exceptions.ServerError(response)
+
+@pytest.mark.parametrize("error, nack", [
+  (util.RetryableError("503"), True),
+  (requests.exceptions.ConnectionError(), True),
+  (requests.exceptions.Timeout(), True),
+  (api_exceptions.ServiceUnavailable("unavailable"), True),
+  (_github3_server_error(), True),
+  (github3_exceptions.ConnectionError(Exception("reset")), True),
+  (requests.exceptions.InvalidURL(), False),
+  (requests.exceptions.TooManyRedirects(), False),
+  (Exception("Query failed to run by returning code of 404"), False),
+  (ValueError("bad data"), False),
+  (None, False),
+])
+@mock.patch.object(worker.time, "sleep")
+def test_process_message_ack_or_nack(mock_sleep, label_worker, error, nack):
+  label_worker._predictor = mock.MagicMock()
+  label_worker._predictor.predict.return_value = {"bug": .9}
+  label_worker.add_labels_to_issue = mock.MagicMock()
+  if error:
+    label_worker.add_labels_to_issue.side_effect = error
+
+  message = _message()
+  label_worker._process_message(message)
+
+  assert message.nack.called == nack
+  assert message.ack.called != nack
+
+@mock.patch.object(worker.time, "sleep")
+def test_process_message_retries_are_capped(mock_sleep, label_worker):
+  label_worker._predictor = mock.MagicMock()
+  label_worker._predictor.predict.side_effect = util.RetryableError("503")
+
+  # Retries back off.
+  for _ in range(3):
+    message = _message()
+    label_worker._process_message(message)
+    assert message.nack.called
+  assert [c[0][0] for c in mock_sleep.call_args_list] == [1, 2, 4]
+
+  # Messages that keep failing are eventually dropped.
+  message = _message(age_seconds=worker.MAX_RETRY_AGE_SECONDS + 1)
+  label_worker._process_message(message)
+  assert not message.nack.called
+  assert message.ack.called
+
+if __name__ == "__main__":
+  logging.basicConfig(
+      level=logging.INFO,
+      format=('%(levelname)s|%(asctime)s'
+              '|%(pathname)s|%(lineno)d| %(message)s'),
+      datefmt='%Y-%m-%dT%H:%M:%S',
+  )
+  logging.getLogger().setLevel(logging.INFO)
+
+  pytest.main()